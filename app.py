@@ -14,6 +14,14 @@ def create_app():
     app = Flask(__name__)
     app.config.from_object('config.Config')
 
+    from utils.media_store import image_srcset
+    app.jinja_env.filters['srcset'] = image_srcset
+
+    from utils.metrics import instrument_sqlalchemy
+    instrument_sqlalchemy()
+    from utils.sqlite_tuning import tune_sqlite
+    tune_sqlite()
+
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
@@ -21,7 +29,11 @@ def create_app():
     with app.app_context():
         from routes import main_bp
         app.register_blueprint(main_bp)
-        db.create_all()
+        # Schema changes are an explicit step (recreate_db.py); set
+        # INIT_DB_ON_START=1 to run it on boot in development
+        if app.config['INIT_DB_ON_START']:
+            from utils.schema import init_db
+            init_db(db)
 
     @login_manager.user_loader
     def load_user(user_id):
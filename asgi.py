@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import re
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+from app import app
+from models import Story, SceneGeneration
+from utils.async_pipeline import run_in_app
+from utils.media_gc import QuotaExceeded
+from utils.generation_scheduler import QueueFull
+from utils.scene_generations import start_scene_request, run_generation_async, follow_events_async
+
+logging.basicConfig(level=logging.INFO)
+
+# Async serving mode: run with e.g. `uvicorn asgi:application --workers 4`.
+# The long-lived generation endpoints are served natively on the event loop,
+# so an open stream costs a coroutine instead of a thread and scene generation
+# runs as asyncio tasks. Every other route goes to the Flask app unchanged.
+flask_application = WsgiToAsgi(app)
+
+MAX_BODY_BYTES = 1024 * 1024
+SCENE_FIELDS = ('story_id', 'act', 'chapter', 'scene_number')
+EVENTS_PATH = re.compile(r'^/generations/(\d+)/events$')
+
+_background = set()
+
+class RequestTooLarge(Exception):
+    pass
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        if scope['path'] == '/generate_scene' and scope['method'] == 'POST':
+            return await generate_scene(scope, receive, send)
+        match = EVENTS_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            return await generation_events(scope, receive, send, int(match.group(1)))
+    await flask_application(scope, receive, send)
+
+async def generate_scene(scope, receive, send):
+    user_id = _session_user_id(scope)
+    if user_id is None:
+        return await _send_json(send, 401, {'error': 'You must be logged in to generate a scene.'})
+    try:
+        data = json.loads(await _read_body(receive))
+    except RequestTooLarge as e:
+        return await _send_json(send, 413, {'error': str(e)})
+    except ValueError:
+        return await _send_json(send, 400, {'error': 'The request body must be JSON.'})
+    missing = [field for field in SCENE_FIELDS if field not in data] if isinstance(data, dict) else list(SCENE_FIELDS)
+    if missing:
+        return await _send_json(send, 400, {'error': f"Missing fields: {', '.join(missing)}"})
+    try:
+        generation_id = await run_in_app(app, start_scene_request, app, user_id, data, runner=_runner(asyncio.get_running_loop()))
+    except QuotaExceeded as e:
+        return await _send_json(send, 507, {'error': str(e)})
+    except QueueFull as e:
+        return await _send_json(send, 429, {'error': str(e), 'retry_after': e.retry_after}, [(b'retry-after', str(e.retry_after).encode())])
+    except Exception as e:
+        logging.error(f"Error in generate_scene: {str(e)}")
+        return await _send_json(send, 500, {'error': str(e)})
+    if generation_id is None:
+        return await _send_json(send, 404, {'error': 'Story not found or you do not have permission to access it.'})
+    await _stream_events(scope, receive, send, generation_id)
+
+async def generation_events(scope, receive, send, generation_id):
+    user_id = _session_user_id(scope)
+    if user_id is None:
+        return await _send_json(send, 401, {'error': 'You must be logged in to follow a generation.'})
+    if not await run_in_app(app, _owns_generation, user_id, generation_id):
+        return await _send_json(send, 404, {'error': 'Generation not found or you do not have permission to access it.'})
+    await _stream_events(scope, receive, send, generation_id)
+
+def _owns_generation(user_id, generation_id):
+    return SceneGeneration.query.join(Story).filter(SceneGeneration.id == generation_id, Story.user_id == user_id).count() > 0
+
+# start_scene_request runs in a worker thread; the generation itself is
+# scheduled back onto this event loop.
+def _runner(loop):
+    def run(app, generation_id, options):
+        loop.call_soon_threadsafe(_spawn, run_generation_async(app, generation_id, options))
+    return run
+
+def _spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+async def _stream_events(scope, receive, send, generation_id):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+            (b'x-generation-id', str(generation_id).encode()),
+        ],
+    })
+
+    async def stream():
+        await send({'type': 'http.response.body', 'body': b'retry: 2000\n\n', 'more_body': True})
+        async for seq, data in follow_events_async(app, generation_id, _last_event_id(scope)):
+            await send({'type': 'http.response.body', 'body': f"id: {seq}\ndata: {data}\n\n".encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    # A client that goes away only stops the stream; the generation carries on
+    streaming = asyncio.ensure_future(stream())
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    done, pending = await asyncio.wait({streaming, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    if streaming in done:
+        streaming.result()
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestTooLarge('Request body too large')
+        if not message.get('more_body'):
+            return body
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+def _last_event_id(scope):
+    value = _headers(scope).get('last-event-id')
+    if not value:
+        query = dict(part.split('=', 1) for part in scope.get('query_string', b'').decode().split('&') if '=' in part)
+        value = query.get('last_event_id')
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        return 0
+
+# Reads the user id from Flask's signed session cookie, exactly as the Flask
+# routes would see it.
+def _session_user_id(scope):
+    cookie = parse_cookie(_headers(scope).get('cookie', '')).get(app.config['SESSION_COOKIE_NAME'])
+    serializer = app.session_interface.get_signing_serializer(app)
+    if not cookie or serializer is None:
+        return None
+    try:
+        data = serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('user_id')
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
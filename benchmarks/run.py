@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+def directory_bytes(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latencies = {}
+        self.first_event = []
+        self.queries = {}
+        self.errors = {}
+
+    def endpoint(self):
+        return getattr(self.local, 'endpoint', 'background')
+
+    def count_query(self):
+        with self.lock:
+            self.queries.setdefault(self.endpoint(), []).append(1)
+
+    def begin(self, endpoint):
+        self.local.endpoint = endpoint
+
+    def end(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        self.local.endpoint = 'background'
+
+    def report(self, requests_per_endpoint):
+        return {
+            endpoint: {
+                **summarize(latencies),
+                'errors': self.errors.get(endpoint, 0),
+                'db_queries_per_request': len(self.queries.get(endpoint, [])) / max(requests_per_endpoint.get(endpoint, 1), 1),
+            }
+            for endpoint, latencies in sorted(self.latencies.items())
+        }
+
+def timed(recorder, endpoint, call):
+    recorder.begin(endpoint)
+    started = time.perf_counter()
+    response = call()
+    elapsed = time.perf_counter() - started
+    recorder.end(endpoint, elapsed, response.status_code < 400)
+    return response
+
+# Reads the scene's server-sent events. Time to first event is measured to
+# the first frame carrying data, not to the stream's `retry:` preamble.
+def stream_scene(recorder, client, payload):
+    recorder.begin('generate_scene')
+    started = time.perf_counter()
+    response = client.post('/generate_scene', json=payload, buffered=False)
+    first = None
+    ok = response.status_code < 400
+    buffered = ''
+    try:
+        for chunk in response.response:
+            buffered += chunk.decode('utf-8', 'replace')
+            *frames, buffered = buffered.split('\n\n')
+            for frame in frames:
+                data = [line[len('data:'):].strip() for line in frame.splitlines() if line.startswith('data:')]
+                if not data:
+                    continue
+                if first is None:
+                    first = time.perf_counter() - started
+                if json.loads('\n'.join(data)).get('status') == 'error':
+                    ok = False
+    finally:
+        response.close()
+    recorder.end('generate_scene', time.perf_counter() - started, ok)
+    if first is not None:
+        with recorder.lock:
+            recorder.first_event.append(first)
+
+# One simulated reader: register, create a story, generate a few scenes one
+# after another the way static/js/main.js does, then open the library and the
+# story page.
+def user_session(app, recorder, scenes, think_time):
+    client = app.test_client()
+    name = f"bench_{uuid.uuid4().hex[:10]}"
+    timed(recorder, 'register', lambda: client.post('/register', data={'username': name, 'email': f'{name}@example.com', 'password': 'bench'}))
+    timed(recorder, 'login', lambda: client.post('/login', data={'username': name, 'password': 'bench'}))
+    response = timed(recorder, 'generate_story', lambda: client.post('/generate_story', json={'topic': f'A lighthouse keeper who {name}'}))
+    story_id = response.get_json()['story_id']
+    for _ in range(scenes):
+        next_scene = timed(recorder, 'get_next_scene', lambda: client.post('/get_next_scene', json={'story_id': story_id})).get_json()
+        if 'act' not in next_scene:
+            break
+        stream_scene(recorder, client, {'story_id': story_id, **next_scene})
+        time.sleep(think_time)
+    timed(recorder, 'my_stories', lambda: client.get('/my_stories'))
+    timed(recorder, 'view_story', lambda: client.get(f'/story/{story_id}'))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the story generation pipeline against offline provider stand-ins.")
+    parser.add_argument('--users', type=int, default=4, help="concurrent simulated users")
+    parser.add_argument('--sessions', type=int, default=8, help="total user sessions to run")
+    parser.add_argument('--scenes', type=int, default=3, help="scenes generated per session")
+    parser.add_argument('--think-time', type=float, default=0.0, help="seconds a user waits between scenes")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="multiplier applied to every stub latency")
+    parser.add_argument('--profile', help="JSON file overriding stub provider settings, see benchmarks/stubs.py")
+    parser.add_argument('--no-rate-limits', action='store_true', help="lift the provider gateway's rate limits to measure the app's own overhead")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='storygen_bench_')
+    media_root = os.path.join(workdir, 'static')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault('MEDIA_ROOT', media_root)
+    os.environ.setdefault('LLM_CACHE_PATH', os.path.join(workdir, 'llm_cache.db'))
+    os.environ.setdefault('TTS_CACHE_PATH', os.path.join(workdir, 'tts_cache'))
+    for key in ('GROQ_API_KEY', 'GEMINI_API_KEY', 'TOGETHER_API_KEY'):
+        os.environ.setdefault(key, 'bench')
+    if args.no_rate_limits:
+        unlimited = {'rate': 1000, 'burst': 1000}
+        os.environ['PROVIDER_LIMITS'] = json.dumps({name: unlimited for name in ('groq', 'gemini', 'together', 'gtts', 'unsplash')})
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import event
+    from app import app, db
+    from utils.schema import init_db
+    from benchmarks.stubs import StubProviders
+
+    profile = None
+    if args.profile:
+        with open(args.profile) as f:
+            profile = json.load(f)
+    stubs = StubProviders(profile, seed=args.seed, time_scale=args.time_scale)
+    stubs.install()
+
+    recorder = Recorder()
+    with app.app_context():
+        init_db(db)
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: recorder.count_query())
+
+    bytes_before = directory_bytes(media_root)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [pool.submit(user_session, app, recorder, args.scenes, args.think_time) for _ in range(args.sessions)]
+        failures = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f"session failed: {e}", file=sys.stderr)
+    wall_time = time.perf_counter() - started
+
+    requests_per_endpoint = {endpoint: len(values) for endpoint, values in recorder.latencies.items()}
+    results = {
+        'config': vars(args),
+        'wall_time_s': wall_time,
+        'sessions_failed': failures,
+        'scenes_per_minute': len(recorder.first_event) / wall_time * 60 if wall_time else 0,
+        'endpoints': recorder.report(requests_per_endpoint),
+        'generate_scene_time_to_first_event': summarize(recorder.first_event),
+        'static_bytes_written': directory_bytes(media_root) - bytes_before,
+        'providers': stubs.report(),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
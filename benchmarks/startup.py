@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds a fresh interpreter may take to import and create the app
+DEFAULT_BUDGET = 1.5
+
+# SDKs that must stay out of the import path; they load on first provider use
+DEFERRED_MODULES = ('groq', 'google.generativeai', 'together', 'gtts', 'PIL')
+
+PROBE = f'''
+import json, sys, time
+started = time.perf_counter()
+from app import app
+ready = time.perf_counter() - started
+print(json.dumps({{'seconds': ready, 'loaded': [name for name in {DEFERRED_MODULES!r} if name in sys.modules]}}))
+'''
+
+# Starts the app in a clean interpreter, without API keys and against an
+# empty database, the way a freshly forked web or job worker would.
+def measure_once(workdir):
+    env = {key: value for key, value in os.environ.items() if not key.endswith('_API_KEY')}
+    env['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+    env['INIT_DB_ON_START'] = '0'
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long a cold worker takes to import and create the app.")
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help="fail when the median startup exceeds this many seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        runs = [measure_once(workdir) for _ in range(args.runs)]
+    seconds = [run['seconds'] for run in runs]
+    results = {
+        'runs': len(seconds),
+        'median': statistics.median(seconds),
+        'max': max(seconds),
+        'budget': args.budget,
+        'eager_imports': sorted({name for run in runs for name in run['loaded']}),
+    }
+    print(json.dumps(results, indent=2))
+
+    if results['median'] > args.budget or results['eager_imports']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+
+# Offline stand-ins for Groq, Gemini, Together/FLUX and gTTS. Each provider
+# gets a latency distribution (lognormal around a median), an error rate and
+# a payload size; the numbers below roughly match what production sees.
+DEFAULT_PROFILE = {
+    'groq': {'median_ms': 900, 'sigma': 0.35, 'error_rate': 0.0, 'payload_chars': 2500},
+    'gemini': {'median_ms': 4000, 'sigma': 0.4, 'error_rate': 0.0, 'payload_chars': 2400, 'paragraphs': 4, 'chunks': 12},
+    'together': {'median_ms': 2500, 'sigma': 0.3, 'error_rate': 0.0, 'width': 1024, 'height': 768},
+    'gtts': {'median_ms': 1200, 'sigma': 0.3, 'error_rate': 0.0, 'bytes_per_char': 60},
+}
+
+LOREM = ("The lanterns guttered as Mara crossed the flooded square, her boots finding the old stones by memory. "
+         "\"You came back,\" the ferryman said, not looking up from the rope he was splicing. "
+         "Somewhere beyond the seawall a bell rang twice, then stopped, and the silence that followed felt deliberate. ")
+
+class StubProviderError(Exception):
+    def __init__(self, provider):
+        super().__init__(f"stub {provider} failure")
+        self.status_code = 503
+
+class StubProviders:
+    def __init__(self, profile=None, seed=None, time_scale=1.0):
+        self.profile = {name: {**settings, **(profile or {}).get(name, {})} for name, settings in DEFAULT_PROFILE.items()}
+        self.random = random.Random(seed)
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.calls = {name: 0 for name in self.profile}
+        self.errors = {name: 0 for name in self.profile}
+        self._image_cache = {}
+
+    def _latency(self, name):
+        settings = self.profile[name]
+        with self.lock:
+            self.calls[name] += 1
+            delay = self.random.lognormvariate(0, settings['sigma']) * settings['median_ms'] / 1000
+            failed = self.random.random() < settings['error_rate']
+            if failed:
+                self.errors[name] += 1
+        return delay * self.time_scale, failed
+
+    def _wait(self, name):
+        delay, failed = self._latency(name)
+        time.sleep(delay)
+        if failed:
+            raise StubProviderError(name)
+
+    def _text(self, chars, paragraphs=1):
+        text = (LOREM * (chars // len(LOREM) + 1))[:chars]
+        sentences = text.split('. ')
+        per_paragraph = max(1, -(-len(sentences) // paragraphs))
+        return '\n\n'.join('. '.join(sentences[i:i + per_paragraph]) for i in range(0, len(sentences), per_paragraph))
+
+    def groq_completion(self, messages=None, model=None, **kwargs):
+        self._wait('groq')
+        content = self._text(self.profile['groq']['payload_chars'])
+        message = type('Message', (), {'content': content})()
+        choice = type('Choice', (), {'message': message})()
+        return type('Completion', (), {'choices': [choice]})()
+
+    def gemini_generate(self, prompt, stream=False, generation_config=None, **kwargs):
+        settings = self.profile['gemini']
+        if generation_config:
+            self._wait('gemini')
+            count = int(prompt.split('Write all ')[1].split()[0]) if 'Write all ' in prompt else 3
+            scenes = [{'scene_number': i + 1, 'paragraphs': self._text(settings['payload_chars'], settings['paragraphs']).split('\n\n')} for i in range(count)]
+            return type('Response', (), {'text': json.dumps({'scenes': scenes})})()
+        text = self._text(settings['payload_chars'], settings['paragraphs'])
+        if not stream:
+            self._wait('gemini')
+            return type('Response', (), {'text': text})()
+        delay, failed = self._latency('gemini')
+        if failed:
+            time.sleep(delay / settings['chunks'])
+            raise StubProviderError('gemini')
+        step = len(text) // settings['chunks'] + 1
+
+        def chunks():
+            for i in range(0, len(text), step):
+                time.sleep(delay / settings['chunks'])
+                yield type('Chunk', (), {'parts': [1], 'text': text[i:i + step]})()
+        return chunks()
+
+    # Async clients used by the ASGI serving path; waits yield to the event loop.
+    async def gemini_generate_async(self, prompt, stream=False, generation_config=None, **kwargs):
+        if not stream:
+            return await asyncio.to_thread(self.gemini_generate, prompt, generation_config=generation_config)
+        settings = self.profile['gemini']
+        text = self._text(settings['payload_chars'], settings['paragraphs'])
+        delay, failed = self._latency('gemini')
+        if failed:
+            await asyncio.sleep(delay / settings['chunks'])
+            raise StubProviderError('gemini')
+        step = len(text) // settings['chunks'] + 1
+
+        async def chunks():
+            for i in range(0, len(text), step):
+                await asyncio.sleep(delay / settings['chunks'])
+                yield type('Chunk', (), {'parts': [1], 'text': text[i:i + step]})()
+        return chunks()
+
+    async def together_generate_async(self, prompt=None, **kwargs):
+        delay, failed = self._latency('together')
+        await asyncio.sleep(delay)
+        if failed:
+            raise StubProviderError('together')
+        return await asyncio.to_thread(self._image_response)
+
+    def together_generate(self, prompt=None, width=1024, height=768, **kwargs):
+        self._wait('together')
+        return self._image_response()
+
+    def _image_response(self):
+        settings = self.profile['together']
+        size = (settings['width'], settings['height'])
+        with self.lock:
+            # Vary the colour per call so the media store sees distinct images
+            colour = tuple(self.random.randrange(256) for _ in range(3))
+            if size not in self._image_cache:
+                # Noise keeps encoder cost and compressed size close to a real render
+                self._image_cache[size] = Image.effect_noise(size, 48).convert('RGB')
+        image = Image.blend(self._image_cache[size], Image.new('RGB', size, colour), 0.5)
+        buffer = BytesIO()
+        image.save(buffer, format='PNG', compress_level=1)
+        data = type('Data', (), {'b64_json': base64.b64encode(buffer.getvalue()).decode('ascii')})()
+        return type('ImageResponse', (), {'data': [data]})()
+
+    def gtts_class(self):
+        stubs = self
+
+        class StubTTS:
+            def __init__(self, text, lang='en', timeout=None, **kwargs):
+                self.text = text
+
+            def write_to_fp(self, fp):
+                stubs._wait('gtts')
+                size = len(self.text) * stubs.profile['gtts']['bytes_per_char']
+                with stubs.lock:
+                    fp.write(stubs.random.randbytes(size))
+
+        return StubTTS
+
+    # Swaps the provider clients the app uses for these stand-ins. The app
+    # modules are imported first so their own client registrations happen
+    # before, not after, the swap.
+    def install(self):
+        from utils import story_generator, image_generator, text_to_speech
+        from utils.providers import client, register_client
+        client('groq').chat.completions.create = self.groq_completion
+        story_generator.scene_creation_agent.model.generate_content = self.gemini_generate
+        # Patched on the resource classes: each FLUX call builds its own
+        # images resource with the attempt's timeout
+        type(client('together').images).generate = self.together_generate
+        story_generator.scene_creation_agent.model.generate_content_async = self.gemini_generate_async
+        type(client('together_async').images).generate = self.together_generate_async
+        register_client('gtts', self.gtts_class)
+
+    def report(self):
+        return {'calls': dict(self.calls), 'errors': dict(self.errors)}
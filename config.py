@@ -1,10 +1,110 @@
+import json
 import os
 
+def _with_overrides(limits, overrides):
+    for name, values in json.loads(overrides or '{}').items():
+        limits[name] = {**limits.get(name, {}), **values}
+    return limits
+
+# Pool settings for every backend; SQLite additionally waits up to its busy
+# timeout for the write lock instead of failing with "database is locked".
+# In-memory SQLite uses a single-connection pool that takes no sizing.
+def _engine_options(uri, pool_size, max_overflow, pool_timeout, busy_timeout):
+    if uri.startswith('sqlite') and (':memory:' in uri or uri in ('sqlite://', 'sqlite:///')):
+        return {}
+    options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout, 'pool_recycle': 3600}
+    if uri.startswith('sqlite'):
+        options['connect_args'] = {'timeout': busy_timeout}
+    return options
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///storytelling.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 20)
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT') or 30)
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT') or 30)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLALCHEMY_ENGINE_OPTIONS = _engine_options(SQLALCHEMY_DATABASE_URI, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, SQLITE_BUSY_TIMEOUT)
     GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
     GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
     UNSPLASH_ACCESS_KEY = os.environ.get('UNSPLASH_ACCESS_KEY')
     GOOGLE_CLOUD_TTS_CREDENTIALS = os.environ.get('GOOGLE_CLOUD_TTS_CREDENTIALS')
+    IMAGE_CONCURRENCY = int(os.environ.get('IMAGE_CONCURRENCY') or 4)
+    AUDIO_CONCURRENCY = int(os.environ.get('AUDIO_CONCURRENCY') or 4)
+    LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') != '0'
+    LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH') or os.path.join('instance', 'llm_cache.db')
+    LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES') or 256 * 1024 * 1024)
+    LLM_CACHE_MAX_AGE = int(os.environ.get('LLM_CACHE_MAX_AGE') or 30 * 24 * 3600)
+    MEDIA_ROOT = os.environ.get('MEDIA_ROOT') or 'static'
+    IMAGE_FORMAT = (os.environ.get('IMAGE_FORMAT') or 'webp').lower()
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY') or 80)
+    IMAGE_THUMBNAIL_WIDTHS = [int(w) for w in (os.environ.get('IMAGE_THUMBNAIL_WIDTHS') or '320,640').split(',') if w]
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 2)
+    JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER') or 300)
+    JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL') or 5)
+    STREAM_SCENE_TEXT = os.environ.get('STREAM_SCENE_TEXT', '1') != '0'
+    SCENE_CONTEXT_SUMMARIES = int(os.environ.get('SCENE_CONTEXT_SUMMARIES') or 6)
+    CHARACTER_PROFILE_CHARS = int(os.environ.get('CHARACTER_PROFILE_CHARS') or 400)
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS') or 4)
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE') or 16)
+    PROVIDER_DEFAULTS = {
+        'rate': 2.0, 'burst': 5, 'concurrency': 8, 'timeout': 60, 'deadline': 180,
+        'retries': 3, 'backoff': 1.0, 'max_backoff': 20, 'failure_threshold': 5, 'reset_after': 30,
+    }
+    # JSON overrides, e.g. PROVIDER_LIMITS='{"groq": {"rate": 1, "concurrency": 2}}'
+    PROVIDER_LIMITS = _with_overrides({
+        'groq': {'rate': 0.5, 'burst': 3, 'concurrency': 4},
+        'gemini': {'rate': 1.0, 'burst': 5, 'concurrency': 8, 'timeout': 120, 'deadline': 240},
+        'together': {'rate': 1.0, 'burst': 4, 'concurrency': IMAGE_CONCURRENCY},
+        'gtts': {'rate': 4.0, 'burst': 8, 'concurrency': AUDIO_CONCURRENCY, 'timeout': 30},
+        'command': {'rate': 100.0, 'burst': 100, 'concurrency': AUDIO_CONCURRENCY, 'timeout': 30, 'retries': 1},
+        'unsplash': {'rate': 0.5, 'burst': 2, 'concurrency': 2, 'timeout': 10, 'retries': 1},
+    }, os.environ.get('PROVIDER_LIMITS'))
+
+    @classmethod
+    def provider_limits(cls, name):
+        return {**cls.PROVIDER_DEFAULTS, **cls.PROVIDER_LIMITS.get(name, {})}
+    PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '0') != '0'
+    PREFETCH_DEPTH = int(os.environ.get('PREFETCH_DEPTH') or 1)
+    PREFETCH_MEDIA = os.environ.get('PREFETCH_MEDIA', '0') != '0'
+    PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS') or 2)
+    PREFETCH_TTL = int(os.environ.get('PREFETCH_TTL') or 1800)
+    PREFETCH_ABANDON_AFTER = int(os.environ.get('PREFETCH_ABANDON_AFTER') or 900)
+    SCENE_BATCH_MODE = os.environ.get('SCENE_BATCH_MODE') or 'scene'
+    JOB_BATCH_MODE = os.environ.get('JOB_BATCH_MODE') or 'chapter'
+    SCENE_GENERATION_WORKERS = int(os.environ.get('SCENE_GENERATION_WORKERS') or 8)
+    GENERATION_CONCURRENCY = int(os.environ.get('GENERATION_CONCURRENCY') or SCENE_GENERATION_WORKERS)
+    GENERATION_PER_USER = int(os.environ.get('GENERATION_PER_USER') or 2)
+    GENERATION_USER_QUEUE = int(os.environ.get('GENERATION_USER_QUEUE') or 4)
+    GENERATION_QUEUE_LIMIT = int(os.environ.get('GENERATION_QUEUE_LIMIT') or 64)
+    STORY_GENERATIONS_PER_USER = int(os.environ.get('STORY_GENERATIONS_PER_USER') or 1)
+    EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL') or 0.25)
+    EVENT_STREAM_POLL = float(os.environ.get('EVENT_STREAM_POLL') or 0.5)
+    EXPORT_CACHE_PATH = os.environ.get('EXPORT_CACHE_PATH') or os.path.join('instance', 'exports')
+    EVENT_LOG_RETENTION = int(os.environ.get('EVENT_LOG_RETENTION') or 86400)
+    MEDIA_GC_GRACE = int(os.environ.get('MEDIA_GC_GRACE') or 86400)
+    MEDIA_GC_MIN_GRACE = int(os.environ.get('MEDIA_GC_MIN_GRACE') or 3600)
+    MEDIA_ARCHIVE_PATH = os.environ.get('MEDIA_ARCHIVE_PATH')
+    # Storage quotas in bytes; 0 disables the quota
+    MEDIA_QUOTA_PER_USER = int(os.environ.get('MEDIA_QUOTA_PER_USER') or 0)
+    MEDIA_QUOTA_TOTAL = int(os.environ.get('MEDIA_QUOTA_TOTAL') or 0)
+    IMAGE_PROMPT_WORDS = int(os.environ.get('IMAGE_PROMPT_WORDS') or 30)
+    # Estimated Jaccard similarity between distilled prompts above which a
+    # story's earlier image is reused; 0 disables reuse
+    IMAGE_REUSE_THRESHOLD = float(os.environ.get('IMAGE_REUSE_THRESHOLD') or 0.6)
+    IMAGE_REUSE_WINDOW = int(os.environ.get('IMAGE_REUSE_WINDOW') or 200)
+    # Words of context in each search result snippet
+    SEARCH_SNIPPET_TOKENS = int(os.environ.get('SEARCH_SNIPPET_TOKENS') or 16)
+    # Text-to-speech backend ('gtts', or 'command' for a local engine run as
+    # TTS_COMMAND), its voice and language
+    TTS_BACKEND = os.environ.get('TTS_BACKEND') or 'gtts'
+    TTS_VOICE = os.environ.get('TTS_VOICE') or 'com'
+    TTS_LANGUAGE = os.environ.get('TTS_LANGUAGE') or 'en'
+    TTS_COMMAND = os.environ.get('TTS_COMMAND')
+    # Synthesized sentences, kept until unused for TTS_CACHE_MAX_AGE seconds
+    TTS_CACHE_PATH = os.environ.get('TTS_CACHE_PATH') or os.path.join('instance', 'tts_cache')
+    TTS_CACHE_MAX_AGE = int(os.environ.get('TTS_CACHE_MAX_AGE') or 30 * 86400)
+    INIT_DB_ON_START = os.environ.get('INIT_DB_ON_START', '0') != '0'
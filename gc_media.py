@@ -0,0 +1,41 @@
+import argparse
+import json
+import logging
+import sys
+from config import Config
+
+def print_report(report):
+    from utils.media_gc import format_bytes
+    for kind, stored in sorted(report['stored'].items()):
+        print(f"{kind}: {stored['files']} files, {format_bytes(stored['bytes'])} stored")
+    print(f"Unreferenced media files: {report['orphaned']}")
+    for kind, reclaimed in sorted(report['reclaimed'].items()):
+        verb = 'to collect' if report['dry_run'] else ('archived' if report['archive'] else 'deleted')
+        print(f"{kind}: {reclaimed['files']} files {verb}, {format_bytes(reclaimed['bytes'])}")
+    print(f"Reclaimed: {format_bytes(report['reclaimed_bytes'])}{' (dry run)' if report['dry_run'] else ''}")
+    print(f"Media stored after collection: {format_bytes(report['total_bytes'])}")
+    if report['over_quota_users']:
+        print(f"Users over their media quota: {', '.join(str(user_id) for user_id in report['over_quota_users'])}")
+    if report['over_total_quota']:
+        print(f"Media storage is over the {format_bytes(Config.MEDIA_QUOTA_TOTAL)} quota")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect generated media no story refers to and measure storage quotas.")
+    parser.add_argument('--grace', type=int, default=None, help=f"only collect files older than this many seconds (default {Config.MEDIA_GC_GRACE})")
+    parser.add_argument('--archive', default=Config.MEDIA_ARCHIVE_PATH, help="move collected files under this directory instead of deleting them")
+    parser.add_argument('--dry-run', action='store_true', help="report what would be collected without touching anything")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from app import app
+    from utils.media_gc import collect_garbage
+    with app.app_context():
+        report = collect_garbage(grace=args.grace, archive=args.archive, dry_run=args.dry_run)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    # Non-zero when quotas are exceeded, so cron can alert on it
+    sys.exit(1 if report['over_total_quota'] or report['over_quota_users'] else 0)
@@ -8,6 +8,9 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bytes of stored media the user's stories refer to, as measured by the
+    # last media collection run (gc_media.py); None until the first run.
+    media_bytes = db.Column(db.BigInteger)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -21,20 +24,109 @@ class Story(db.Model):
     topic = db.Column(db.String(200), nullable=False)
     book_spec = db.Column(db.Text, nullable=True)
     outline = db.Column(db.Text, nullable=True)
+    outline_index = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     user = db.relationship('User', backref=db.backref('stories', lazy=True))
 
+    __table_args__ = (db.Index('ix_story_user_created', 'user_id', 'created_at', 'id'),)
+
 class Scene(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
     act = db.Column(db.Integer, nullable=False)
     chapter = db.Column(db.Integer, nullable=False)
     scene_number = db.Column(db.Integer, nullable=False)
+    # Legacy JSON paragraph blob; emptied once migrated into Paragraph rows.
     content = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(500), nullable=True)
     audio_url = db.Column(db.String(500), nullable=True)
+    summary = db.Column(db.Text, nullable=True)
     is_generated = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     story = db.relationship('Story', backref=db.backref('scenes', lazy=True))
+    paragraphs = db.relationship('Paragraph', back_populates='scene', order_by='Paragraph.position', cascade='all, delete-orphan', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_scene_story_position', 'story_id', 'act', 'chapter', 'scene_number'),
+        db.Index('ix_scene_story_pending', 'story_id', 'is_generated', 'act', 'chapter', 'scene_number'),
+    )
+
+    def paragraph_dicts(self):
+        return [paragraph.to_dict() for paragraph in self.paragraphs]
+
+class Paragraph(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    scene_id = db.Column(db.Integer, db.ForeignKey('scene.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    image_url = db.Column(db.String(500), nullable=True, index=True)
+    audio_url = db.Column(db.String(500), nullable=True, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    scene = db.relationship('Scene', back_populates='paragraphs')
+
+    __table_args__ = (db.UniqueConstraint('scene_id', 'position', name='uq_paragraph_scene_position'),)
+
+    def to_dict(self):
+        return {'content': self.text, 'image_url': self.image_url, 'audio_url': self.audio_url}
+
+class GenerationJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    total_scenes = db.Column(db.Integer, nullable=False, default=0)
+    completed_scenes = db.Column(db.Integer, nullable=False, default=0)
+    worker_id = db.Column(db.String(120), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    story = db.relationship('Story', backref=db.backref('generation_jobs', lazy=True))
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'story_id': self.story_id,
+            'status': self.status,
+            'total_scenes': self.total_scenes,
+            'completed_scenes': self.completed_scenes,
+            'error': self.error,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+# One detached run of the scene pipeline. Its events are appended to
+# GenerationEvent so clients can reconnect and replay what they missed.
+class SceneGeneration(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
+    act = db.Column(db.Integer, nullable=False)
+    chapter = db.Column(db.Integer, nullable=False)
+    scene_number = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='running')
+    last_seq = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_scene_generation_scene', 'story_id', 'act', 'chapter', 'scene_number', 'status'),)
+
+class GenerationEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    generation_id = db.Column(db.Integer, db.ForeignKey('scene_generation.id', ondelete='CASCADE'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('generation_id', 'seq', name='uq_generation_event_seq'),)
+
+# Distilled image prompts generated for a story, with the MinHash signature
+# used to find a near-duplicate prompt whose image can be reused.
+class ImagePrompt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False, index=True)
+    prompt = db.Column(db.Text, nullable=False)
+    signature = db.Column(db.LargeBinary, nullable=False)
+    image_url = db.Column(db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
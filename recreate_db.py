@@ -1,6 +1,7 @@
 from app import app, db
+from utils.schema import init_db
 
 with app.app_context():
-    db.create_all()
+    init_db(db)
 
 print("Database recreated successfully.")
@@ -1,11 +1,29 @@
 import logging
-from flask import Blueprint, render_template, request, jsonify, Response, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, jsonify, Response, redirect, url_for, flash, session, stream_with_context, current_app, send_file
 from werkzeug.security import check_password_hash
-from models import db, User, Story, Scene
-from utils.story_generator import generate_book_spec, generate_outline, generate_scene, generate_chapter_scenes
-from utils.image_generator import generate_images_for_paragraphs, generate_image_for_paragraph
-from utils.text_to_speech import generate_audio_for_scene
+from sqlalchemy import tuple_, insert
+from sqlalchemy.orm import selectinload, load_only
+from models import db, User, Story, Scene, Paragraph, GenerationJob, SceneGeneration
+from utils.story_generator import generate_book_spec, generate_outline, generate_chapter_scenes
+from utils.image_generator import generate_image_for_paragraph
+from utils.scene_pipeline import next_ungenerated_scene, scene_context, generate_chapter_drafts
+from utils.outline_index import parse_outline
+from utils.prefetch import touch
+from utils.scene_generations import start_scene_request, follow_events
+from utils.generation_jobs import enqueue_job, TERMINAL_STATUSES
+from utils.media_gc import check_media_quota, QuotaExceeded
+from utils.generation_scheduler import scheduler, QueueFull
+from utils.metrics import expose
+from utils.pagination import decode_cursor, page_size, keyset_page
+from utils.search import search
+from utils.media_store import image_srcset, media_path
+from utils.text_to_speech import stream_paragraph_audio
+from utils.book_export import EXPORT_FORMATS, story_digest, cached_export_path, export_chunks, stream_and_cache
+from config import Config
 import json
+import os
+import time
+from datetime import datetime
 
 main_bp = Blueprint('main', __name__)
 logging.basicConfig(level=logging.INFO)
@@ -64,31 +82,33 @@ def generate_story():
         return jsonify({'error': 'You must be logged in to generate a story.'}), 401
     
     topic = request.json['topic']
+    use_cache = request.json.get('use_cache', True)
     
-    book_spec = generate_book_spec(topic)
-    outline = generate_outline(book_spec)
+    try:
+        with scheduler.story_slot(session['user_id']):
+            book_spec = generate_book_spec(topic, use_cache=use_cache)
+            outline = generate_outline(book_spec, use_cache=use_cache)
+    except QueueFull as e:
+        return _too_many_requests(e)
+    
+    outline_index = json.dumps(parse_outline(outline))
     
-    new_story = Story(user_id=session['user_id'], topic=topic, book_spec=book_spec, outline=outline)
+    new_story = Story(user_id=session['user_id'], topic=topic, book_spec=book_spec, outline=outline, outline_index=outline_index)
     db.session.add(new_story)
-    db.session.commit()
+    db.session.flush()
     
     acts = 5
     chapters_per_act = 5
     scenes_per_chapter = 3
     
-    for act in range(1, acts + 1):
-        for chapter in range(1, chapters_per_act + 1):
-            for scene in range(1, scenes_per_chapter + 1):
-                new_scene = Scene(
-                    story_id=new_story.id,
-                    act=act,
-                    chapter=chapter,
-                    scene_number=scene,
-                    content="",
-                    is_generated=False
-                )
-                db.session.add(new_scene)
-    
+    # The story and its skeleton scenes go in one short transaction, the
+    # scenes as a single multi-row insert
+    db.session.execute(insert(Scene), [
+        {'story_id': new_story.id, 'act': act, 'chapter': chapter, 'scene_number': scene, 'content': '', 'is_generated': False}
+        for act in range(1, acts + 1)
+        for chapter in range(1, chapters_per_act + 1)
+        for scene in range(1, scenes_per_chapter + 1)
+    ])
     db.session.commit()
     
     return jsonify({
@@ -107,7 +127,8 @@ def get_next_scene():
     if not story:
         return jsonify({'error': 'Story not found or you do not have permission to access it.'}), 404
 
-    next_scene = Scene.query.filter_by(story_id=story_id, is_generated=False).order_by(Scene.act, Scene.chapter, Scene.scene_number).first()
+    touch(story.id)
+    next_scene = next_ungenerated_scene(story_id)
 
     if next_scene:
         return jsonify({
@@ -124,45 +145,57 @@ def generate_scene_route():
         return jsonify({'error': 'You must be logged in to generate a scene.'}), 401
     
     try:
-        story_id = request.json['story_id']
-        act = request.json['act']
-        chapter = request.json['chapter']
-        scene_number = request.json['scene_number']
-        
-        story = Story.query.filter_by(id=story_id, user_id=session['user_id']).first()
-        if not story:
+        generation_id = start_scene_request(current_app._get_current_object(), session['user_id'], request.json)
+        if generation_id is None:
             return jsonify({"error": "Story not found or you do not have permission to access it."}), 404
-
-        def generate():
-            yield json.dumps({"status": "generating_paragraphs"}) + "\n"
-            logging.info("Starting scene generation")
-
-            paragraphs = generate_scene(story.book_spec, story.outline, act, chapter, scene_number)
-            yield json.dumps({"status": "paragraphs_generated"}) + "\n"
-
-            logging.info("Generating images and audio for paragraphs")
-            paragraphs_with_images = generate_images_for_paragraphs([{'content': p} for p in paragraphs])
-            for i, para in enumerate(paragraphs_with_images):
-                logging.info(f"Generating audio for paragraph {i+1}")
-                audio_url = generate_audio_for_scene(para['content'])
-                para['audio_url'] = audio_url
-                yield json.dumps({"status": "image_generated", "paragraph": para, "index": i}) + "\n"
-
-            scene_content = json.dumps(paragraphs_with_images)
-            scene = Scene.query.filter_by(story_id=story_id, act=act, chapter=chapter, scene_number=scene_number).first()
-            if scene:
-                scene.content = scene_content
-                scene.is_generated = True
-                db.session.commit()
-            
-            yield json.dumps({"status": "complete", "scene_id": scene.id}) + "\n"
-        
-        return Response(generate(), mimetype='text/event-stream')
+        return _event_stream(generation_id, _last_event_id())
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
+    except QueueFull as e:
+        return _too_many_requests(e)
     except Exception as e:
         logging.error(f"Error in generate_scene_route: {str(e)}")
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def _too_many_requests(error):
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def _last_event_id():
+    value = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        return 0
+
+# Server-sent events replayed from the generation's event log; the id of each
+# event is its sequence number, so a client that reconnects with
+# Last-Event-ID only receives what it missed.
+def _event_stream(generation_id, after_seq):
+    def generate():
+        yield "retry: 2000\n\n"
+        for seq, data in follow_events(generation_id, after_seq):
+            yield f"id: {seq}\ndata: {data}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['X-Generation-Id'] = str(generation_id)
+    return response
+
+@main_bp.route('/generations/<int:generation_id>/events')
+def generation_events(generation_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to follow a generation.'}), 401
+    
+    generation = SceneGeneration.query.join(Story).filter(SceneGeneration.id == generation_id, Story.user_id == session['user_id']).first()
+    if not generation:
+        return jsonify({'error': 'Generation not found or you do not have permission to access it.'}), 404
+    return _event_stream(generation.id, _last_event_id())
+
 @main_bp.route('/generate_chapter_scenes', methods=['POST'])
 def generate_chapter_scenes_route():
     if 'user_id' not in session:
@@ -172,12 +205,22 @@ def generate_chapter_scenes_route():
         story_id = request.json['story_id']
         act = request.json['act']
         chapter = request.json['chapter']
+        use_cache = request.json.get('use_cache', True)
+        persist = request.json.get('persist', False)
         
         story = Story.query.filter_by(id=story_id, user_id=session['user_id']).first()
         if not story:
             return jsonify({'error': 'Story not found or you do not have permission to access it.'}), 404
         
-        scenes = generate_chapter_scenes(story.book_spec, story.outline, act, chapter)
+        if persist:
+            drafts = generate_chapter_drafts(story, act, chapter, use_cache=use_cache)
+            return jsonify({
+                'act': act,
+                'chapter': chapter,
+                'scenes': {str(number): paragraphs for number, paragraphs in drafts.items()}
+            })
+        
+        scenes = generate_chapter_scenes(story.book_spec, scene_context(story, act, chapter, 1), act, chapter, use_cache=use_cache)
         
         return jsonify({
             'act': act,
@@ -186,17 +229,173 @@ def generate_chapter_scenes_route():
         })
     except Exception as e:
         logging.error(f"Error in generate_chapter_scenes_route: {str(e)}")
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@main_bp.route('/generate_book', methods=['POST'])
+def generate_book():
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to generate a book.'}), 401
+    
+    story_id = request.json['story_id']
+    story = Story.query.filter_by(id=story_id, user_id=session['user_id']).first()
+    if not story:
+        return jsonify({'error': 'Story not found or you do not have permission to access it.'}), 404
+    
+    try:
+        check_media_quota(session['user_id'])
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
+    
+    job, created = enqueue_job(story)
+    return jsonify(job.to_dict()), 202 if created else 200
+
+def _get_user_job(job_id):
+    return GenerationJob.query.join(Story).filter(GenerationJob.id == job_id, Story.user_id == session['user_id']).first()
+
+@main_bp.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to view a job.'}), 401
+    
+    job = _get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or you do not have permission to access it.'}), 404
+    return jsonify(job.to_dict())
+
+@main_bp.route('/jobs/<int:job_id>/stream')
+def job_stream(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to view a job.'}), 401
+    
+    job = _get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or you do not have permission to access it.'}), 404
+
+    def generate():
+        last = None
+        while True:
+            current = GenerationJob.query.get(job_id)
+            progress = current.to_dict()
+            if progress != last:
+                yield json.dumps(progress) + "\n"
+                last = progress
+            if current.status in TERMINAL_STATUSES:
+                return
+            # End the read transaction so the next poll sees the worker's commits
+            db.session.commit()
+            time.sleep(Config.JOB_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@main_bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to cancel a job.'}), 401
+    
+    job = _get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or you do not have permission to access it.'}), 404
+    if job.status not in TERMINAL_STATUSES:
+        job.status = 'cancelled'
+        db.session.commit()
+    return jsonify(job.to_dict())
+
+@main_bp.route('/metrics')
+def metrics():
+    return Response(expose(), mimetype='text/plain; version=0.0.4')
+
+def _stories_page(user_id, cursor, limit):
+    query = Story.query.options(load_only(Story.id, Story.topic, Story.created_at)).filter_by(user_id=user_id).order_by(Story.created_at.desc(), Story.id.desc())
+    if cursor:
+        created_at, story_id = decode_cursor(cursor, 2)
+        query = query.filter(tuple_(Story.created_at, Story.id) < (datetime.fromisoformat(str(created_at)), story_id))
+    return keyset_page(query, limit, lambda story: [story.created_at.isoformat(), story.id])
+
+def _scenes_page(story_id, cursor, limit):
+    query = Scene.query.options(selectinload(Scene.paragraphs)).filter_by(story_id=story_id).order_by(Scene.act, Scene.chapter, Scene.scene_number)
+    if cursor:
+        query = query.filter(tuple_(Scene.act, Scene.chapter, Scene.scene_number) > tuple(decode_cursor(cursor, 3)))
+    return keyset_page(query, limit, lambda scene: [scene.act, scene.chapter, scene.scene_number])
+
+def _scene_json(scene):
+    paragraphs = []
+    for paragraph in scene.paragraphs if scene.is_generated else []:
+        data = paragraph.to_dict()
+        data['srcset'] = image_srcset(paragraph.image_url)
+        data['audio_stream_url'] = url_for('main.paragraph_audio', scene_id=scene.id, index=paragraph.position)
+        paragraphs.append(data)
+    return {
+        'id': scene.id,
+        'act': scene.act,
+        'chapter': scene.chapter,
+        'scene_number': scene.scene_number,
+        'is_generated': scene.is_generated,
+        'paragraphs': paragraphs
+    }
+
 @main_bp.route('/my_stories')
 def my_stories():
     if 'user_id' not in session:
         flash('You must be logged in to view your stories.')
         return redirect(url_for('main.login'))
     
-    user = User.query.get(session['user_id'])
-    stories = Story.query.filter_by(user_id=user.id).order_by(Story.created_at.desc()).all()
-    return render_template('my_stories.html', stories=stories)
+    try:
+        stories, next_cursor = _stories_page(session['user_id'], request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError:
+        return redirect(url_for('main.my_stories'))
+    return render_template('my_stories.html', stories=stories, next_cursor=next_cursor)
+
+@main_bp.route('/api/stories')
+def list_stories():
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to list stories.'}), 401
+    
+    try:
+        stories, next_cursor = _stories_page(session['user_id'], request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'stories': [{'id': story.id, 'topic': story.topic, 'created_at': story.created_at.isoformat()} for story in stories],
+        'next_cursor': next_cursor
+    })
+
+@main_bp.route('/search')
+def search_stories():
+    if 'user_id' not in session:
+        flash('You must be logged in to search your stories.')
+        return redirect(url_for('main.login'))
+    
+    query = request.args.get('q', '').strip()
+    try:
+        results, next_cursor = search(session['user_id'], query, request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError:
+        return redirect(url_for('main.search_stories', q=query))
+    return render_template('search.html', query=query, results=results, next_cursor=next_cursor)
+
+@main_bp.route('/api/search')
+def search_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to search your stories.'}), 401
+    
+    try:
+        results, next_cursor = search(session['user_id'], request.args.get('q', ''), request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+@main_bp.route('/api/stories/<int:story_id>/scenes')
+def list_scenes(story_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to read a story.'}), 401
+    
+    if not Story.query.filter_by(id=story_id, user_id=session['user_id']).count():
+        return jsonify({'error': 'Story not found or you do not have permission to access it.'}), 404
+    try:
+        scenes, next_cursor = _scenes_page(story_id, request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'scenes': [_scene_json(scene) for scene in scenes], 'next_cursor': next_cursor})
 
 @main_bp.route('/story/<int:story_id>')
 def view_story(story_id):
@@ -209,8 +408,46 @@ def view_story(story_id):
         flash('Story not found or you do not have permission to view it.')
         return redirect(url_for('main.my_stories'))
     
-    scenes = Scene.query.filter_by(story_id=story.id).order_by(Scene.act, Scene.chapter, Scene.scene_number).all()
-    return render_template('view_story.html', story=story, scenes=scenes)
+    return render_template('view_story.html', story=story)
+
+@main_bp.route('/story/<int:story_id>/export/<kind>')
+def export_story(story_id, kind):
+    if 'user_id' not in session:
+        flash('You must be logged in to export a story.')
+        return redirect(url_for('main.login'))
+    
+    story = Story.query.filter_by(id=story_id, user_id=session['user_id']).first()
+    if not story:
+        flash('Story not found or you do not have permission to export it.')
+        return redirect(url_for('main.my_stories'))
+    if kind not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unknown export format: {kind}'}), 404
+    
+    mimetype, extension = EXPORT_FORMATS[kind]
+    digest = story_digest(story, kind)
+    if digest in request.if_none_match:
+        return Response(status=304, headers={'ETag': f'"{digest}"'})
+    download_name = f"story_{story.id}.{extension}"
+    path = cached_export_path(story, kind, digest)
+    if os.path.exists(path):
+        response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name, etag=digest)
+    else:
+        response = Response(stream_with_context(stream_and_cache(export_chunks(story, kind), path)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        response.headers['ETag'] = f'"{digest}"'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _json_body():
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+# The paragraph position a JSON body names, or -1 when it is not an integer
+def _paragraph_index(data):
+    try:
+        return int(data.get('index', 0))
+    except (TypeError, ValueError):
+        return -1
 
 @main_bp.route('/edit_scene/<int:scene_id>', methods=['GET', 'POST'])
 def edit_scene(scene_id):
@@ -226,14 +463,72 @@ def edit_scene(scene_id):
         return redirect(url_for('main.my_stories'))
     
     if request.method == 'POST':
-        content = request.form.get('content')
-        scene.content = json.dumps([{'content': content, 'image_url': scene.image_url, 'audio_url': scene.audio_url}])
+        if request.is_json:
+            data = _json_body()
+            content = data.get('content')
+            position = _paragraph_index(data)
+        else:
+            content = request.form.get('content')
+            position = request.args.get('index', 0, type=int)
+        if not isinstance(content, str) or position < 0:
+            if request.is_json:
+                return jsonify({'error': 'content must be a string and index a non-negative integer.'}), 400
+            flash('The scene could not be updated.')
+            return render_template('edit_scene.html', scene=scene, content='', index=position), 400
+        # The old audio no longer matches; it is rebuilt from the sentence
+        # cache the next time the paragraph is played
+        updated = Paragraph.query.filter_by(scene_id=scene.id, position=position).update({'text': content, 'audio_url': None})
+        if not updated:
+            # A generated scene can gain a paragraph at its end; anywhere
+            # else, and on a scene whose rows are still the generation's
+            # draft, there is nothing to edit
+            next_position = db.session.query(db.func.coalesce(db.func.max(Paragraph.position) + 1, 0)).filter_by(scene_id=scene.id).scalar()
+            if not scene.is_generated or position != next_position:
+                db.session.rollback()
+                if request.is_json:
+                    return jsonify({'error': 'Paragraph not found.'}), 404
+                flash('Paragraph not found.')
+                return render_template('edit_scene.html', scene=scene, content='', index=position), 404
+            db.session.add(Paragraph(scene_id=scene.id, position=position, text=content))
         db.session.commit()
+        if request.is_json:
+            return jsonify({
+                'scene_id': scene.id,
+                'index': position,
+                'audio_stream_url': url_for('main.paragraph_audio', scene_id=scene.id, index=position)
+            })
         flash('Scene updated successfully.')
         return redirect(url_for('main.view_story', story_id=story.id))
     
-    scene_content = json.loads(scene.content)[0]['content'] if scene.content else ''
-    return render_template('edit_scene.html', scene=scene, content=scene_content)
+    position = request.args.get('index', 0, type=int)
+    paragraph = Paragraph.query.filter_by(scene_id=scene.id, position=position).first()
+    return render_template('edit_scene.html', scene=scene, content=paragraph.text if paragraph else '', index=position)
+
+# Plays a paragraph's audio. Stored audio is served as a file; otherwise the
+# paragraph is synthesized sentence by sentence, each sentence sent as soon
+# as it is ready (from the cache where possible), and the assembled file is
+# saved for the next request.
+@main_bp.route('/scene/<int:scene_id>/audio/<int:index>')
+def paragraph_audio(scene_id, index):
+    if 'user_id' not in session:
+        return jsonify({'error': 'You must be logged in to play audio.'}), 401
+    
+    paragraph = Paragraph.query.join(Scene).join(Story).filter(Paragraph.scene_id == scene_id, Paragraph.position == index, Story.user_id == session['user_id']).first()
+    if not paragraph:
+        return jsonify({'error': 'Paragraph not found or you do not have permission to access it.'}), 404
+    if media_path(paragraph.audio_url):
+        return redirect(paragraph.audio_url)
+    
+    paragraph_id, text = paragraph.id, paragraph.text
+    
+    def on_stored(audio_url):
+        # Unless the paragraph was edited meanwhile
+        Paragraph.query.filter_by(id=paragraph_id, text=text).update({'audio_url': audio_url})
+        db.session.commit()
+    
+    response = Response(stream_with_context(stream_paragraph_audio(text, on_stored)), mimetype='audio/mpeg')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @main_bp.route('/regenerate_image/<int:scene_id>', methods=['POST'])
 def regenerate_image_route(scene_id):
@@ -246,13 +541,17 @@ def regenerate_image_route(scene_id):
     if story.user_id != session['user_id']:
         return jsonify({'error': 'You do not have permission to regenerate this image.'}), 403
     
+    position = _paragraph_index(_json_body())
+    if position < 0:
+        return jsonify({'error': 'index must be a non-negative integer.'}), 400
+    paragraph = Paragraph.query.filter_by(scene_id=scene.id, position=position).first()
+    if not paragraph:
+        return jsonify({'error': 'Paragraph not found.'}), 404
+    
     try:
-        scene_content = json.loads(scene.content)[0]['content']
-        new_image_url = generate_image_for_paragraph(scene_content)
+        new_image_url = generate_image_for_paragraph(paragraph.text)
         
-        scene_data = json.loads(scene.content)
-        scene_data[0]['image_url'] = new_image_url
-        scene.content = json.dumps(scene_data)
+        paragraph.image_url = new_image_url
         db.session.commit()
         
         return jsonify({'new_image_url': new_image_url})
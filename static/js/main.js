@@ -101,27 +101,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorData.error || 'Failed to generate scene');
             }
             
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
-            
-            while (true) {
-                const { done, value } = await reader.read();
-                if (done) break;
-                
-                const chunk = decoder.decode(value);
-                const lines = chunk.split('\n');
-                
-                for (const line of lines) {
-                    if (line.trim()) {
-                        try {
-                            const data = JSON.parse(line);
-                            handleStreamedData(data);
-                        } catch (error) {
-                            console.error('Error parsing JSON:', error, 'Raw data:', line);
-                        }
-                    }
-                }
-            }
+            await followGeneration(response);
         } catch (error) {
             console.error('Error:', error);
             alert(`Failed to generate scene: ${error.message}`);
@@ -130,6 +110,81 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // The scene keeps generating on the server if the connection drops, so
+    // reconnect and replay only the events after the last one received.
+    async function followGeneration(response) {
+        const generationId = response.headers.get('X-Generation-Id');
+        let lastEventId = null;
+        let attempts = 0;
+
+        while (true) {
+            let finished = false;
+            try {
+                finished = await readEventStream(response, (id, data) => {
+                    if (id) lastEventId = id;
+                    handleStreamedData(data);
+                    return data.status === 'complete' || data.status === 'error';
+                });
+            } catch (error) {
+                console.error('Scene stream interrupted:', error);
+            }
+            if (finished) return;
+            if (!generationId || attempts >= 5) {
+                throw new Error('Lost connection to scene generation');
+            }
+            attempts += 1;
+            updateProgressMessage('Connection lost. Reconnecting...');
+            await new Promise((resolve) => setTimeout(resolve, 1000 * attempts));
+            response = await fetch(`/generations/${generationId}/events`, {
+                headers: lastEventId ? { 'Last-Event-ID': lastEventId } : {},
+            });
+            if (!response.ok) {
+                throw new Error('Failed to resume scene generation');
+            }
+        }
+    }
+
+    // Parses server-sent events, buffering partial events across chunks.
+    // Returns true once onEvent reports the terminal event.
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) return false;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let id = null;
+                const dataLines = [];
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('id:')) {
+                        id = line.slice(3).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).replace(/^ /, ''));
+                    }
+                }
+                if (!dataLines.length) continue;
+                let data;
+                try {
+                    data = JSON.parse(dataLines.join('\n'));
+                } catch (error) {
+                    console.error('Error parsing JSON:', error, 'Raw data:', dataLines.join('\n'));
+                    continue;
+                }
+                if (onEvent(id, data)) {
+                    reader.cancel();
+                    return true;
+                }
+            }
+        }
+    }
+
     function handleStreamedData(data) {
         if (!data || typeof data !== 'object') {
             console.error('Invalid data received:', data);
@@ -137,10 +192,22 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         switch (data.status) {
+            case 'queued':
+                updateProgressMessage(`Waiting for a free slot (position ${data.position} in the queue)...`);
+                break;
             case 'generating_paragraphs':
                 updateProgressMessage('Generating paragraphs...');
                 break;
+            case 'text_delta':
+                updateDraft(data.text);
+                break;
+            case 'paragraph_complete':
+                if (typeof data.index === 'number') {
+                    displayParagraph({ content: data.content }, data.index);
+                }
+                break;
             case 'paragraphs_generated':
+                removeDraft();
                 updateProgressMessage('Paragraphs generated. Generating images and audio...');
                 break;
             case 'image_generated':
@@ -151,9 +218,20 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
                 break;
             case 'complete':
+                // Paragraph buttons only learn their scene once it has been saved
+                sceneContainer.querySelectorAll('button[data-scene-id=""]').forEach((button) => {
+                    button.dataset.sceneId = data.scene_id;
+                });
                 updateProgressMessage('Scene generation complete');
                 toggleLoadingIndicator(false);
                 break;
+            case 'error':
+                removeDraft();
+                updateProgressMessage(`Scene generation failed: ${data.error}`);
+                break;
+            case 'timings':
+                console.info(`Scene ${data.scene} timings:`, data.stages);
+                break;
             default:
                 console.warn('Unknown status:', data.status);
         }
@@ -172,6 +250,28 @@ document.addEventListener('DOMContentLoaded', () => {
         return progressElement;
     }
 
+    // Shows the paragraph the model is still writing; closed paragraphs
+    // arrive separately as paragraph_complete events.
+    function updateDraft(text) {
+        let draftElement = document.getElementById('draft-paragraph');
+        if (!draftElement) {
+            draftElement = document.createElement('p');
+            draftElement.id = 'draft-paragraph';
+            draftElement.className = 'paragraph-text';
+            draftElement.dataset.text = '';
+            sceneContainer.appendChild(draftElement);
+        }
+        draftElement.dataset.text += text;
+        draftElement.textContent = draftElement.dataset.text.split('\n\n').pop();
+    }
+
+    function removeDraft() {
+        const draftElement = document.getElementById('draft-paragraph');
+        if (draftElement) {
+            draftElement.remove();
+        }
+    }
+
     function displayParagraph(paragraph, index) {
         if (!paragraph || typeof paragraph !== 'object') {
             console.error('Invalid paragraph data:', paragraph);
@@ -180,6 +280,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const paragraphElement = document.createElement('div');
         paragraphElement.className = 'card';
+        paragraphElement.dataset.index = index;
         paragraphElement.innerHTML = `
             <div class="card-content">
                 <img src="${paragraph.image_url || '/static/images/placeholder.svg'}" alt="Scene Image" class="scene-image">
@@ -190,11 +291,20 @@ document.addEventListener('DOMContentLoaded', () => {
                         Your browser does not support the audio element.
                     </audio>
                 ` : ''}
-                <button class="edit-content" data-scene-id="${storyData.story_id}" data-paragraph-index="${index}">Edit Content</button>
-                <button class="regenerate-image" data-scene-id="${storyData.story_id}" data-paragraph-index="${index}">Regenerate Image</button>
+                <button class="edit-content" data-scene-id="${paragraph.scene_id || ''}" data-paragraph-index="${index}">Edit Content</button>
+                <button class="regenerate-image" data-scene-id="${paragraph.scene_id || ''}" data-paragraph-index="${index}">Regenerate Image</button>
             </div>
         `;
-        sceneContainer.appendChild(paragraphElement);
+        // Paragraphs arrive in completion order; keep them in reading order and
+        // replace the text-only card once its media is ready.
+        const existingElement = sceneContainer.querySelector(`.card[data-index="${index}"]`);
+        if (existingElement) {
+            existingElement.replaceWith(paragraphElement);
+        } else {
+            const nextElement = Array.from(sceneContainer.querySelectorAll('.card[data-index], #draft-paragraph'))
+                .find((element) => element.id === 'draft-paragraph' || Number(element.dataset.index) > index);
+            sceneContainer.insertBefore(paragraphElement, nextElement || null);
+        }
 
         const editButton = paragraphElement.querySelector('.edit-content');
         const regenerateButton = paragraphElement.querySelector('.regenerate-image');
@@ -203,7 +313,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     async function editContent(sceneId, index) {
-        const paragraphElement = sceneContainer.querySelectorAll('.card')[index];
+        const paragraphElement = sceneContainer.querySelector(`.card[data-index="${index}"]`);
         const paragraphText = paragraphElement.querySelector('.paragraph-text');
         const currentContent = paragraphText.textContent;
 
@@ -222,7 +332,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     throw new Error('Failed to update content');
                 }
 
+                const data = await response.json();
                 paragraphText.textContent = newContent;
+                // The old recording no longer matches the text
+                const audioElement = paragraphElement.querySelector('.audio-player');
+                if (audioElement) {
+                    audioElement.querySelector('source').src = data.audio_stream_url;
+                    audioElement.load();
+                }
             } catch (error) {
                 console.error('Error:', error);
                 alert('Failed to update content. Please try again.');
@@ -231,7 +348,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     async function regenerateImage(sceneId, index) {
-        const paragraphElement = sceneContainer.querySelectorAll('.card')[index];
+        const paragraphElement = sceneContainer.querySelector(`.card[data-index="${index}"]`);
         const imageElement = paragraphElement.querySelector('.scene-image');
 
         try {
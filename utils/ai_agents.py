@@ -1,33 +1,52 @@
 import os
-from groq import Groq
-import google.generativeai as genai
+from functools import cached_property
+from utils.llm_cache import cached_completion, cached_stream, cached_stream_async
+from utils.providers import provider, register_client, client
 
-groq_api_key = os.environ.get('GROQ_API_KEY')
-gemini_api_key = os.environ.get('GEMINI_API_KEY')
+def _groq_client():
+    from groq import Groq
+    # Retries and timeouts are handled by the provider gateway
+    return Groq(api_key=os.environ.get('GROQ_API_KEY'), max_retries=0)
 
-groq_client = Groq(api_key=groq_api_key)
-genai.configure(api_key=gemini_api_key)
+def _gemini_client():
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
+    return genai
 
-class BrainstormingAgent:
-    def __init__(self):
-        self.model = "gemma2-9b-it"
+register_client('groq', _groq_client)
+register_client('gemini', _gemini_client)
 
-    def generate_log_line(self, topic):
-        prompt = f"Generate a log line and characters for a story based on the topic: '{topic}'. Use Blake Snyder's format: On the verge of a stasis=death moment, a flawed protagonist has a catalyst and breaks into Act Two; but when the midpoint happens, they must learn the theme stated, before Act Three leads to the finale where the flawed protagonist defeats (or doesn't defeat) the antagonistic force."
-        completion = groq_client.chat.completions.create(
+def _groq_completion(model, system_prompt, prompt, use_cache):
+    def call():
+        completion = provider('groq').call(lambda timeout: client('groq').chat.completions.create(
             messages=[
-                {"role": "system", "content": "You are an expert storyteller."},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
-            model=self.model,
-        )
+            model=model,
+            timeout=timeout,
+        ))
         return completion.choices[0].message.content
+    return cached_completion(model, system_prompt, prompt, None, call, use_cache)
+
+async def _text_chunks(response):
+    async for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+class BrainstormingAgent:
+    def __init__(self):
+        self.model = "gemma2-9b-it"
+
+    def generate_log_line(self, topic, use_cache=True):
+        prompt = f"Generate a log line and characters for a story based on the topic: '{topic}'. Use Blake Snyder's format: On the verge of a stasis=death moment, a flawed protagonist has a catalyst and breaks into Act Two; but when the midpoint happens, they must learn the theme stated, before Act Three leads to the finale where the flawed protagonist defeats (or doesn't defeat) the antagonistic force."
+        return _groq_completion(self.model, "You are an expert storyteller.", prompt, use_cache)
 
 class StoryStructureAgent:
     def __init__(self):
         self.model = "llama-3.1-70b-versatile"
 
-    def generate_5_act_structure(self, log_line):
+    def generate_5_act_structure(self, log_line, use_cache=True):
         prompt = f'''Based on this log line: '{log_line}', generate a detailed 5-act story structure. 
         create a detailed character profile for each character in the story.
         For each act, provide 3-5 chapters, and for each chapter, provide a brief description.
@@ -39,22 +58,37 @@ class StoryStructureAgent:
         - Chapter 3: [Brief description]
         (Continue for Acts 2-5)'''
 
-        completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are an expert story structure creator."},
-                {"role": "user", "content": prompt}
-            ],
-            model=self.model,
-        )
-        return completion.choices[0].message.content
+        return _groq_completion(self.model, "You are an expert story structure creator.", prompt, use_cache)
+
+CHAPTER_SCENES_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'scenes': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'scene_number': {'type': 'integer'},
+                    'paragraphs': {'type': 'array', 'items': {'type': 'string'}},
+                },
+                'required': ['scene_number', 'paragraphs'],
+            },
+        },
+    },
+    'required': ['scenes'],
+}
 
 class SceneCreationAgent:
     def __init__(self):
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.model_name = 'gemini-1.5-flash'
 
-    def generate_chapter_scenes(self, act_structure, act_number, chapter_number):
+    @cached_property
+    def model(self):
+        return client('gemini').GenerativeModel(self.model_name)
+
+    def generate_chapter_scenes(self, act_structure, act_number, chapter_number, use_cache=True):
         prompt = f'''
-        Based on this 5-act story structure:
+        Based on this context from the story's 5-act structure:
         {act_structure}
         
         Generate 3 detailed scenes for Act {act_number}, Chapter {chapter_number}. 
@@ -74,12 +108,58 @@ class SceneCreationAgent:
         Scene 3:
         [Scene details]
         '''
-        response = self.model.generate_content(prompt)
-        return response.text
+        return self._generate(prompt, use_cache)
 
-    def generate_scene(self, act_structure, act_number, chapter_number, scene_number):
+    def generate_chapter_scenes_structured(self, act_structure, act_number, chapter_number, scene_count, use_cache=True, parse=None):
         prompt = f'''
-        Based on this 5-act story structure:
+        Based on this context from the story's 5-act structure:
+        {act_structure}
+        
+        Write all {scene_count} scenes of Act {act_number}, Chapter {chapter_number} as finished prose.
+        Each scene should include:
+        1. Vivid description of the setting
+        2. Character interactions and dialogue
+        3. Conflict or tension in the scene
+        4. How this scene advances the overall plot
+        
+        Each scene should be 3-5 paragraphs of engaging, show-don't-tell storytelling,
+        and each scene should pick up where the previous one left off.
+        Return the scenes in order, numbered 1 to {scene_count}, with each paragraph as a separate string.
+        '''
+        generation_config = {'response_mime_type': 'application/json', 'response_schema': CHAPTER_SCENES_SCHEMA}
+
+        def call():
+            return provider('gemini').call(lambda timeout: self.model.generate_content(
+                prompt, generation_config=generation_config, request_options={'timeout': timeout})).text
+        return cached_completion(self.model_name, None, prompt, generation_config, call, use_cache, parse)
+
+    def generate_scene(self, act_structure, act_number, chapter_number, scene_number, use_cache=True):
+        prompt = self._scene_prompt(act_structure, act_number, chapter_number, scene_number)
+        return self._generate(prompt, use_cache)
+
+    def stream_scene(self, act_structure, act_number, chapter_number, scene_number, use_cache=True):
+        prompt = self._scene_prompt(act_structure, act_number, chapter_number, scene_number)
+
+        def stream_call():
+            for chunk in provider('gemini').stream(lambda timeout: self.model.generate_content(
+                    prompt, stream=True, request_options={'timeout': timeout})):
+                if chunk.parts:
+                    yield chunk.text
+
+        return cached_stream(self.model_name, None, prompt, None, stream_call, use_cache)
+
+    def stream_scene_async(self, act_structure, act_number, chapter_number, scene_number, use_cache=True):
+        prompt = self._scene_prompt(act_structure, act_number, chapter_number, scene_number)
+
+        async def stream_call():
+            return _text_chunks(provider('gemini').stream_async(lambda timeout: self.model.generate_content_async(
+                prompt, stream=True, request_options={'timeout': timeout})))
+
+        return cached_stream_async(self.model_name, None, prompt, None, stream_call, use_cache)
+
+    def _scene_prompt(self, act_structure, act_number, chapter_number, scene_number):
+        return f'''
+        Based on this context from the story's 5-act structure:
         {act_structure}
         
         Generate a detailed scene for Act {act_number}, Chapter {chapter_number}, Scene {scene_number}. 
@@ -91,5 +171,9 @@ class SceneCreationAgent:
         
         Aim for 3-5 paragraphs of engaging, show-don't-tell storytelling.
         '''
-        response = self.model.generate_content(prompt)
-        return response.text
+
+    def _generate(self, prompt, use_cache):
+        def call():
+            return provider('gemini').call(lambda timeout: self.model.generate_content(
+                prompt, request_options={'timeout': timeout})).text
+        return cached_completion(self.model_name, None, prompt, None, call, use_cache)
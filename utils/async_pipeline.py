@@ -0,0 +1,94 @@
+import asyncio
+import functools
+import logging
+import time
+from config import Config
+from models import db, Story
+from utils.story_generator import stream_scene_paragraphs_async
+from utils.scene_pipeline import precomputed_text, scene_context, checkpoint_scene
+from utils.media_executor import AsyncMediaBatch
+from utils.metrics import trace, record, scenes_generated
+
+logging.basicConfig(level=logging.INFO)
+
+# Database work from coroutines runs in the default thread pool, each call in
+# its own app context and session, so no connection is held across awaits.
+async def run_in_app(app, fn, *args, **kwargs):
+    def call():
+        with app.app_context():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                db.session.remove()
+    return await asyncio.to_thread(call)
+
+def _precomputed(story_id, act, chapter, scene_number, use_cache, batch_mode):
+    story = db.session.get(Story, story_id)
+    return precomputed_text(story, act, chapter, scene_number, use_cache, batch_mode)
+
+def _context(story_id, act, chapter, scene_number):
+    story = db.session.get(Story, story_id)
+    return story.book_spec, scene_context(story, act, chapter, scene_number)
+
+# The scene pipeline of scene_pipeline.generate_scene_events on the event
+# loop: the text streams from the async Gemini client and each paragraph's
+# media is fanned out as tasks the moment the paragraph closes. Yields the
+# same events.
+async def generate_scene_events_async(app, story_id, act, chapter, scene_number, use_cache=True, stream_text=None, batch_mode=None):
+    with trace(story_id=story_id, scene=f"{act}.{chapter}.{scene_number}"):
+        async for event in _scene_events(app, story_id, act, chapter, scene_number, use_cache, stream_text, batch_mode):
+            yield event
+
+async def _scene_events(app, story_id, act, chapter, scene_number, use_cache, stream_text, batch_mode):
+    started = time.perf_counter()
+    if stream_text is None:
+        stream_text = Config.STREAM_SCENE_TEXT
+    batch_mode = batch_mode or Config.SCENE_BATCH_MODE
+    yield {"status": "generating_paragraphs"}
+    logging.info(f"Starting async scene generation for story {story_id}, Act {act}, Chapter {chapter}, Scene {scene_number}")
+
+    batch = AsyncMediaBatch(story_id, functools.partial(run_in_app, app))
+    paragraphs_with_images = {}
+    precomputed = await run_in_app(app, _precomputed, story_id, act, chapter, scene_number, use_cache, batch_mode)
+    if precomputed:
+        paragraphs = precomputed['paragraphs']
+        if stream_text:
+            yield {"status": "text_delta", "text": '\n\n'.join(paragraphs)}
+        for i, content in enumerate(paragraphs):
+            if stream_text:
+                yield {"status": "paragraph_complete", "index": i, "content": content}
+            if i in precomputed['media']:
+                paragraphs_with_images[i] = precomputed['media'][i]
+                yield {"status": "image_generated", "paragraph": paragraphs_with_images[i], "index": i}
+            else:
+                batch.submit(i, content)
+    else:
+        book_spec, context = await run_in_app(app, _context, story_id, act, chapter, scene_number)
+        count = 0
+        async for kind, value in stream_scene_paragraphs_async(book_spec, context, act, chapter, scene_number, use_cache=use_cache):
+            if kind == 'text_delta':
+                if stream_text:
+                    yield {"status": "text_delta", "text": value}
+                continue
+            batch.submit(count, value)
+            if stream_text:
+                yield {"status": "paragraph_complete", "index": count, "content": value}
+            count += 1
+            for i, para in batch.ready():
+                paragraphs_with_images[i] = para
+                yield {"status": "image_generated", "paragraph": para, "index": i}
+    record('scene_text_ready', time.perf_counter() - started)
+    yield {"status": "paragraphs_generated"}
+
+    async for i, para in batch.as_completed():
+        paragraphs_with_images[i] = para
+        yield {"status": "image_generated", "paragraph": para, "index": i}
+
+    scene_id = await run_in_app(app, checkpoint_scene, story_id, act, chapter, scene_number, paragraphs_with_images)
+    if scene_id is None:
+        yield {"status": "error", "error": "Scene not found"}
+        return
+    record('scene_total', time.perf_counter() - started)
+    scenes_generated.inc(source='precomputed' if precomputed else 'async')
+
+    yield {"status": "complete", "scene_id": scene_id}
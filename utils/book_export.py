@@ -0,0 +1,313 @@
+import hashlib
+import html
+import logging
+import os
+import struct
+import tempfile
+import zipfile
+from sqlalchemy import select
+from config import Config
+from models import db, Scene, Paragraph
+from utils.media_store import media_path
+
+logging.basicConfig(level=logging.INFO)
+
+EXPORT_FORMATS = {
+    'epub': ('application/epub+zip', 'epub'),
+    'html': ('application/zip', 'zip'),
+    'audiobook': ('audio/mpeg', 'mp3'),
+}
+# Bump when the layout of an export changes so cached files are rebuilt.
+EXPORT_VERSION = 1
+CHUNK_SIZE = 64 * 1024
+ROW_BATCH = 200
+
+def _rows(story_id):
+    query = (
+        select(Scene.act, Scene.chapter, Scene.scene_number, Paragraph.position, Paragraph.text, Paragraph.image_url, Paragraph.audio_url)
+        .join(Paragraph, Paragraph.scene_id == Scene.id)
+        .where(Scene.story_id == story_id, Scene.is_generated == True)
+        .order_by(Scene.act, Scene.chapter, Scene.scene_number, Paragraph.position)
+        .execution_options(yield_per=ROW_BATCH)
+    )
+    return db.session.execute(query)
+
+def _chapters(story_id):
+    # Groups the paragraph cursor into (act, chapter, rows) without loading
+    # more than one chapter at a time.
+    current, rows = None, []
+    for row in _rows(story_id):
+        if (row.act, row.chapter) != current:
+            if rows:
+                yield current[0], current[1], rows
+            current, rows = (row.act, row.chapter), []
+        rows.append(row)
+    if rows:
+        yield current[0], current[1], rows
+
+# Digest of everything that ends up in an export; exports are cached under it.
+def story_digest(story, kind):
+    digest = hashlib.sha256(f"{EXPORT_VERSION}\0{kind}\0{story.id}\0{story.topic}\0{story.outline or ''}".encode())
+    for row in _rows(story.id):
+        digest.update(f"\0{row.act}.{row.chapter}.{row.scene_number}.{row.position}\0{row.text}\0{row.image_url or ''}\0{row.audio_url or ''}".encode())
+    return digest.hexdigest()[:32]
+
+def cached_export_path(story, kind, digest):
+    return os.path.join(Config.EXPORT_CACHE_PATH, f"story_{story.id}_{digest}.{EXPORT_FORMATS[kind][1]}")
+
+def _read_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+# Streams an export and, once it is complete, keeps a copy under `path` so
+# the next request for the same content is served from disk. An interrupted
+# download leaves nothing behind.
+def stream_and_cache(chunks, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, path)
+        completed = True
+        logging.info(f"Cached export {path}")
+    finally:
+        if not completed:
+            os.unlink(tmp_path)
+
+def export_chunks(story, kind):
+    if kind == 'audiobook':
+        return audiobook_chunks(story)
+    return book_archive_chunks(story, epub=kind == 'epub')
+
+class _ZipSink:
+    # Write-only, unseekable file for zipfile: whatever has been written is
+    # handed out by drain(), so the archive never accumulates in memory.
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, *args):
+        raise OSError("stream is not seekable")
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.buffer = b''.join(self.buffer), []
+        return data
+
+def _xhtml(title, body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title><link rel="stylesheet" href="style.css"/></head>\n'
+        f'<body>\n{body}\n</body>\n</html>\n'
+    )
+
+STYLESHEET = "body { font-family: serif; line-height: 1.5; margin: 1em; } img { max-width: 100%; } h1, h2, h3 { font-family: sans-serif; }\n"
+
+# EPUB 3 or a zipped HTML site with the same structure: the outline, one page
+# per chapter and the images the chapters use. Chapters are written as the
+# cursor reaches them and images are copied from disk in chunks; only the
+# table of contents and manifest (names, not content) are kept until the end.
+def book_archive_chunks(story, epub=True):
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED)
+    prefix = 'OEBPS/' if epub else ''
+    title = story.topic
+    chapters = []
+    images = {}
+
+    if epub:
+        archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/container.xml', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+            '</container>\n'
+        ))
+    archive.writestr(f'{prefix}style.css', STYLESHEET)
+    archive.writestr(f'{prefix}outline.xhtml' if epub else 'outline.html', _xhtml(
+        f"{title}: Outline",
+        f"<h1>{html.escape(title)}</h1>\n<pre>{html.escape(story.outline or '')}</pre>"
+    ))
+    yield sink.drain()
+
+    for act, chapter, rows in _chapters(story.id):
+        name = f"act{act}_chapter{chapter}.{'xhtml' if epub else 'html'}"
+        heading = f"Act {act}, Chapter {chapter}"
+        parts = [f"<h2>{heading}</h2>"]
+        scene_number = None
+        for row in rows:
+            if row.scene_number != scene_number:
+                scene_number = row.scene_number
+                parts.append(f"<h3>Scene {scene_number}</h3>")
+            source = media_path(row.image_url)
+            if source:
+                image_name = images.get(source)
+                if image_name is None:
+                    image_name = f"images/{os.path.basename(source)}"
+                    images[source] = image_name
+                    # Images are already compressed; deflating them again only costs CPU
+                    info = zipfile.ZipInfo(f'{prefix}{image_name}')
+                    info.compress_type = zipfile.ZIP_STORED
+                    with archive.open(info, 'w') as entry:
+                        for chunk in _read_chunks(source):
+                            entry.write(chunk)
+                            yield sink.drain()
+                parts.append(f'<img src="{image_name}" alt=""/>')
+            parts.append(f"<p>{html.escape(row.text)}</p>")
+        archive.writestr(f'{prefix}{name}', _xhtml(heading, '\n'.join(parts)))
+        chapters.append((name, heading))
+        yield sink.drain()
+
+    outline_name = 'outline.xhtml' if epub else 'outline.html'
+    toc = '\n'.join(f'<li><a href="{name}">{html.escape(heading)}</a></li>' for name, heading in chapters)
+    if epub:
+        archive.writestr('OEBPS/nav.xhtml', _xhtml(title, f'<nav epub:type="toc"><h1>{html.escape(title)}</h1><ol>\n<li><a href="{outline_name}">Outline</a></li>\n{toc}\n</ol></nav>'))
+        archive.writestr('OEBPS/content.opf', _package_document(story, chapters, images.values()))
+    else:
+        archive.writestr('index.html', _xhtml(title, f'<h1>{html.escape(title)}</h1><ol>\n<li><a href="{outline_name}">Outline</a></li>\n{toc}\n</ol>'))
+    archive.close()
+    yield sink.drain()
+
+IMAGE_MEDIA_TYPES = {'.webp': 'image/webp', '.avif': 'image/avif', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.svg': 'image/svg+xml'}
+
+def _package_document(story, chapters, image_names):
+    items = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+        '<item id="style" href="style.css" media-type="text/css"/>',
+        '<item id="outline" href="outline.xhtml" media-type="application/xhtml+xml"/>',
+    ]
+    items += [f'<item id="chapter{i}" href="{name}" media-type="application/xhtml+xml"/>' for i, (name, _) in enumerate(chapters)]
+    for i, name in enumerate(image_names):
+        media_type = IMAGE_MEDIA_TYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+        items.append(f'<item id="image{i}" href="{name}" media-type="{media_type}"/>')
+    spine = ['<itemref idref="outline"/>'] + [f'<itemref idref="chapter{i}"/>' for i in range(len(chapters))]
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="book-id">urn:storygen:story:{story.id}</dc:identifier>'
+        f'<dc:title>{html.escape(story.topic)}</dc:title><dc:language>en</dc:language>'
+        f'<meta property="dcterms:modified">{story.created_at.strftime("%Y-%m-%dT%H:%M:%SZ")}</meta>'
+        '</metadata>\n'
+        f'<manifest>\n{chr(10).join(items)}\n</manifest>\n'
+        f'<spine>\n{chr(10).join(spine)}\n</spine>\n'
+        '</package>\n'
+    )
+
+# --- Audiobook -------------------------------------------------------------
+
+MPEG_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def _id3v2_size(header):
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+# Byte range of the MPEG audio frames in an MP3 (without ID3 tags) and its
+# duration in milliseconds, read from the frame headers alone.
+def mp3_frames(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = _id3v2_size(f.read(10))
+        end = size
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b'TAG':
+                end = size - 128
+        duration = 0.0
+        position = start
+        while position + 4 <= end:
+            f.seek(position)
+            header = f.read(4)
+            if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+                break
+            version = (header[1] >> 3) & 0x03
+            layer = (header[1] >> 1) & 0x03
+            bitrate_index = header[2] >> 4
+            rate_index = (header[2] >> 2) & 0x03
+            if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+                break
+            bitrate = MPEG_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+            sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+            samples = 1152 if version == 3 else 576
+            padding = (header[2] >> 1) & 0x01
+            length = samples // 8 * bitrate // sample_rate + padding
+            duration += samples / sample_rate
+            position += length
+    return start, min(position, end), int(duration * 1000)
+
+def _syncsafe(value):
+    return bytes([(value >> 21) & 0x7F, (value >> 14) & 0x7F, (value >> 7) & 0x7F, value & 0x7F])
+
+def _id3_frame(frame_id, payload):
+    return frame_id.encode() + _syncsafe(len(payload)) + b'\x00\x00' + payload
+
+def _id3_title(text):
+    return _id3_frame('TIT2', b'\x03' + text.encode('utf-8'))
+
+# ID3v2.4 tag with a CHAP frame per chapter and a table of contents, so
+# players show the book's chapters in the single concatenated file.
+def _chapter_tag(title, chapters):
+    frames = [_id3_title(title)]
+    children = b''.join(f"ch{i}".encode() + b'\x00' for i in range(len(chapters)))
+    frames.append(_id3_frame('CTOC', b'toc\x00' + b'\x03' + bytes([len(chapters)]) + children + _id3_title(title)))
+    for i, (heading, start_ms, end_ms) in enumerate(chapters):
+        payload = f"ch{i}".encode() + b'\x00' + struct.pack('>IIII', start_ms, end_ms, 0xFFFFFFFF, 0xFFFFFFFF) + _id3_title(heading)
+        frames.append(_id3_frame('CHAP', payload))
+    body = b''.join(frames)
+    return b'ID3\x04\x00\x00' + _syncsafe(len(body)) + body
+
+# The per-paragraph MP3s in reading order, joined into one file. Chapter
+# times come from a first pass over the frame headers; the second pass copies
+# the audio frames from disk in chunks.
+def audiobook_chunks(story):
+    chapters = []
+    elapsed = 0
+    for act, chapter, rows in _chapters(story.id):
+        started = elapsed
+        for row in rows:
+            path = media_path(row.audio_url)
+            if path:
+                elapsed += mp3_frames(path)[2]
+        if elapsed > started:
+            chapters.append((f"Act {act}, Chapter {chapter}", started, elapsed))
+    yield _chapter_tag(story.topic, chapters[:255])
+
+    for row in _rows(story.id):
+        path = media_path(row.audio_url)
+        if not path:
+            continue
+        start, end, _ = mp3_frames(path)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
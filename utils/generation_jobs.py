@@ -0,0 +1,120 @@
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, update
+from config import Config
+from models import db, Story, Scene, GenerationJob
+from utils.scene_pipeline import generate_scene_events, next_ungenerated_scene
+
+logging.basicConfig(level=logging.INFO)
+
+ACTIVE_STATUSES = ('queued', 'running')
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+def enqueue_job(story):
+    job = GenerationJob.query.filter(GenerationJob.story_id == story.id, GenerationJob.status.in_(ACTIVE_STATUSES)).first()
+    if job:
+        return job, False
+    total = Scene.query.filter_by(story_id=story.id).count()
+    completed = Scene.query.filter_by(story_id=story.id, is_generated=True).count()
+    job = GenerationJob(story_id=story.id, status='queued', total_scenes=total, completed_scenes=completed)
+    db.session.add(job)
+    db.session.commit()
+    return job, True
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _claimable(stale_before):
+    return or_(
+        GenerationJob.status == 'queued',
+        and_(GenerationJob.status == 'running', GenerationJob.heartbeat_at < stale_before)
+    )
+
+# Claiming is a conditional UPDATE, so any number of worker processes on any
+# number of nodes can poll the same table without taking the same job twice.
+# Running jobs whose heartbeat went stale belonged to a crashed worker and are
+# picked up again; they resume from the first scene that is not generated yet.
+def claim_job(worker_id):
+    stale_before = datetime.utcnow() - timedelta(seconds=Config.JOB_STALE_AFTER)
+    candidate = GenerationJob.query.filter(_claimable(stale_before)).order_by(GenerationJob.created_at).first()
+    if not candidate:
+        db.session.rollback()
+        return None
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(GenerationJob)
+        .where(GenerationJob.id == candidate.id, _claimable(stale_before))
+        .values(status='running', worker_id=worker_id, heartbeat_at=now, updated_at=now)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return None
+    db.session.refresh(candidate)
+    return candidate
+
+def _heartbeat(job):
+    db.session.execute(
+        update(GenerationJob)
+        .where(GenerationJob.id == job.id)
+        .values(heartbeat_at=datetime.utcnow())
+    )
+    db.session.commit()
+
+# Ends the job unless it stopped running meanwhile: a cancel from the user
+# (or another worker that took over a stale job) wins over this outcome.
+def _finish(job, status, error=None):
+    result = db.session.execute(
+        update(GenerationJob)
+        .where(GenerationJob.id == job.id, GenerationJob.status == 'running', GenerationJob.worker_id == job.worker_id)
+        .values(status=status, error=error, updated_at=datetime.utcnow())
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def run_job(job):
+    logging.info(f"Worker {job.worker_id} running job {job.id} for story {job.story_id}")
+    story = Story.query.get(job.story_id)
+    try:
+        while True:
+            db.session.refresh(job)
+            if job.status != 'running':
+                logging.info(f"Job {job.id} is {job.status}, stopping")
+                return
+            scene = next_ungenerated_scene(story.id)
+            if not scene:
+                if _finish(job, 'completed'):
+                    logging.info(f"Job {job.id} completed")
+                return
+            beat_at = time.monotonic()
+            for event in generate_scene_events(story, scene.act, scene.chapter, scene.scene_number, batch_mode=Config.JOB_BATCH_MODE):
+                if event['status'] == 'error':
+                    raise RuntimeError(event['error'])
+                # One small write every JOB_HEARTBEAT_INTERVAL, not one per event
+                if time.monotonic() - beat_at >= Config.JOB_HEARTBEAT_INTERVAL:
+                    _heartbeat(job)
+                    beat_at = time.monotonic()
+            job.completed_scenes = Scene.query.filter_by(story_id=story.id, is_generated=True).count()
+            db.session.commit()
+    except Exception as e:
+        logging.error(f"Job {job.id} failed: {str(e)}")
+        db.session.rollback()
+        _finish(job, 'failed', str(e))
+
+def run_worker(app, once=False):
+    worker_id = worker_name()
+    logging.info(f"Generation worker {worker_id} started")
+    with app.app_context():
+        while True:
+            try:
+                job = claim_job(worker_id)
+                if job:
+                    run_job(job)
+                elif once:
+                    return
+                else:
+                    time.sleep(Config.JOB_POLL_INTERVAL)
+            finally:
+                db.session.remove()
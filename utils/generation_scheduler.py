@@ -0,0 +1,195 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from config import Config
+
+logging.basicConfig(level=logging.INFO)
+
+class QueueFull(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _Entry:
+    def __init__(self, app, user_id, generation_id, start):
+        self.app = app
+        self.user_id = user_id
+        self.generation_id = generation_id
+        self.start = start
+        self.lock = threading.Lock()
+        self.dispatched = False
+        self.started_at = None
+        self.position = None
+        self.log = None
+
+# Admission control for scene generations in this process. At most
+# GENERATION_CONCURRENCY run at once and at most GENERATION_PER_USER per
+# user; the rest wait in per-user queues that are served round-robin, so a
+# user who queues many scenes cannot starve the others. Each provider's own
+# in-flight budget stays with the provider gateway (PROVIDER_LIMITS).
+class GenerationScheduler:
+    def __init__(self, concurrency, per_user, user_queue, queue_limit):
+        self.concurrency = concurrency
+        self.per_user = per_user
+        self.user_queue = user_queue
+        self.queue_limit = queue_limit
+        self.lock = threading.Lock()
+        self.running = {}
+        self.running_by_user = {}
+        # user id -> deque of entries, in round-robin order
+        self.queues = OrderedDict()
+        self.queued = {}
+        self.stories = {}
+        self.average_seconds = {'scene': 30.0, 'story': 15.0}
+        # Queue positions are written to the event logs here, off the request
+        # threads and the event loop, one write at a time.
+        self.announcer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue')
+
+    # Runs `start()` now or once the user's turn comes; raises QueueFull when
+    # the user's queue or the whole queue is full. The run must call
+    # release(generation_id) when it ends.
+    def submit(self, app, user_id, generation_id, start):
+        entry = _Entry(app, user_id, generation_id, start)
+        with self.lock:
+            queue = self.queues.get(user_id)
+            if self._can_start(user_id) and not queue:
+                self._mark_running(entry)
+                ready = [entry]
+            else:
+                if len(queue or ()) >= self.user_queue:
+                    raise QueueFull("You already have the maximum number of scenes waiting to be generated.", self._retry_after(len(queue)))
+                if len(self.queued) >= self.queue_limit:
+                    raise QueueFull("Too many scenes are waiting to be generated; please try again shortly.", self._retry_after(len(self.queued)))
+                self.queues.setdefault(user_id, deque()).append(entry)
+                self.queued[generation_id] = entry
+                ready = self._dispatchable()
+        self._start(ready)
+        self._announce()
+
+    def release(self, generation_id):
+        with self.lock:
+            entry = self.running.pop(generation_id, None)
+            if entry is None:
+                return
+            self.running_by_user[entry.user_id] -= 1
+            if not self.running_by_user[entry.user_id]:
+                del self.running_by_user[entry.user_id]
+            self._observe('scene', time.monotonic() - entry.started_at)
+            ready = self._dispatchable()
+        self._start(ready)
+        self._announce()
+
+    def is_queued(self, generation_id):
+        with self.lock:
+            return generation_id in self.queued
+
+    # Synchronous story creation is only limited per user: a second request
+    # while one is in flight is turned away rather than queued.
+    @contextmanager
+    def story_slot(self, user_id):
+        with self.lock:
+            if self.stories.get(user_id, 0) >= Config.STORY_GENERATIONS_PER_USER:
+                raise QueueFull("A story is already being generated for you.", math.ceil(self.average_seconds['story']))
+            self.stories[user_id] = self.stories.get(user_id, 0) + 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stories[user_id] -= 1
+                if not self.stories[user_id]:
+                    del self.stories[user_id]
+                self._observe('story', time.monotonic() - started)
+
+    def _can_start(self, user_id):
+        return len(self.running) < self.concurrency and self.running_by_user.get(user_id, 0) < self.per_user
+
+    def _mark_running(self, entry):
+        entry.started_at = time.monotonic()
+        self.running[entry.generation_id] = entry
+        self.running_by_user[entry.user_id] = self.running_by_user.get(entry.user_id, 0) + 1
+
+    # Takes queued entries user by user, moving each served user to the back
+    # of the rotation. Called with the lock held.
+    def _dispatchable(self):
+        ready = []
+        progress = True
+        while progress and len(self.running) < self.concurrency:
+            progress = False
+            for user_id in list(self.queues):
+                if len(self.running) >= self.concurrency:
+                    break
+                if not self._can_start(user_id):
+                    continue
+                entry = self.queues[user_id].popleft()
+                if self.queues[user_id]:
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+                del self.queued[entry.generation_id]
+                self._mark_running(entry)
+                ready.append(entry)
+                progress = True
+        return ready
+
+    def _start(self, entries):
+        for entry in entries:
+            # Waits for a position write in progress, so the run resumes the
+            # event log after it
+            with entry.lock:
+                entry.dispatched = True
+            try:
+                entry.start()
+            except Exception as e:
+                logging.error(f"Failed to start generation {entry.generation_id}: {str(e)}")
+                self.release(entry.generation_id)
+
+    # The order queued entries would start in if slots freed up one by one:
+    # round-robin over users, oldest first within each user.
+    def _positions(self):
+        queues = [list(queue) for queue in self.queues.values()]
+        order = []
+        for depth in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[depth] for queue in queues if depth < len(queue))
+        return order
+
+    def _announce(self):
+        with self.lock:
+            changed = []
+            for position, entry in enumerate(self._positions(), start=1):
+                if entry.position != position:
+                    entry.position = position
+                    changed.append((entry, position))
+        if changed:
+            self.announcer.submit(self._write_positions, changed)
+
+    def _write_positions(self, changed):
+        from utils.scene_generations import EventLog
+        for entry, position in changed:
+            with entry.lock:
+                if entry.dispatched:
+                    continue
+                try:
+                    with entry.app.app_context():
+                        entry.log = entry.log or EventLog(entry.generation_id)
+                        entry.log.append({"status": "queued", "position": position})
+                except Exception as e:
+                    logging.error(f"Failed to record queue position of generation {entry.generation_id}: {str(e)}")
+
+    def _observe(self, kind, seconds):
+        self.average_seconds[kind] = 0.8 * self.average_seconds[kind] + 0.2 * seconds
+
+    # Rough wait until a slot frees up for a request `ahead` places back.
+    def _retry_after(self, ahead):
+        return max(1, math.ceil(self.average_seconds['scene'] * (ahead + 1) / self.concurrency))
+
+scheduler = GenerationScheduler(
+    Config.GENERATION_CONCURRENCY,
+    Config.GENERATION_PER_USER,
+    Config.GENERATION_USER_QUEUE,
+    Config.GENERATION_QUEUE_LIMIT
+)
@@ -1,82 +1,142 @@
+import copy
 import os
-import requests
+import asyncio
 import base64
-import time
 import logging
-from together import Together
-from io import BytesIO
-from PIL import Image
+from config import Config
+from utils.media_store import FULL_IMAGE_WIDTH, store_image
+from utils.providers import provider, http_session, register_client, client
+from utils.image_prompts import distill_image_prompt, prompt_signature, find_similar_image, remember_image
+from utils.metrics import image_reuse
 
 UNSPLASH_ACCESS_KEY = os.environ.get('UNSPLASH_ACCESS_KEY')
 TOGETHER_API_KEY = os.environ.get('TOGETHER_API_KEY')
 
-together_client = Together(api_key=TOGETHER_API_KEY)
+# Retries and timeouts are handled by the provider gateway
+def _together_client():
+    from together import Together
+    return Together(api_key=TOGETHER_API_KEY, timeout=Config.provider_limits('together')['timeout'], max_retries=0)
+
+def _async_together_client():
+    from together import AsyncTogether
+    return AsyncTogether(api_key=TOGETHER_API_KEY, timeout=Config.provider_limits('together')['timeout'], max_retries=0)
+
+register_client('together', _together_client)
+register_client('together_async', _async_together_client)
+
+# The Together SDK takes its timeout per client, not per request; this is the
+# client's images resource bound to a copy of its settings with the attempt's
+# timeout, so FLUX calls stay within the gateway's deadline.
+def _flux_images(name, timeout):
+    together = client(name)
+    settings = copy.copy(together.client)
+    settings.timeout = timeout
+    return type(together.images)(settings)
+
+FLUX_REQUEST = {
+    'model': "black-forest-labs/FLUX.1-schnell-Free",
+    'width': FULL_IMAGE_WIDTH,
+    'height': 768,
+    'steps': 4,
+    'n': 1,
+    'response_format': "b64_json",
+}
 
 logging.basicConfig(level=logging.INFO)
 
 def get_unsplash_image(keywords):
-    url = f"https://api.unsplash.com/photos/random?query={keywords}&client_id={UNSPLASH_ACCESS_KEY}"
-    try:
-        response = requests.get(url)
+    url = "https://api.unsplash.com/photos/random"
+    params = {'query': keywords, 'client_id': UNSPLASH_ACCESS_KEY}
+
+    def fetch(timeout):
+        response = http_session().get(url, params=params, timeout=timeout)
         response.raise_for_status()
-        data = response.json()
+        return response.json()
+
+    try:
+        data = provider('unsplash').call(fetch)
         return data['urls']['regular']
-    except requests.exceptions.RequestException as e:
+    except Exception as e:
         logging.error(f"Unsplash API error: {e}")
         return None
 
 def get_flux_image(prompt):
     try:
         logging.info(f"Generating image for prompt: {prompt}")
-        response = together_client.images.generate(
-            prompt=f"A scene depicting: {prompt}",
-            model="black-forest-labs/FLUX.1-schnell-Free",
-            width=1024,
-            height=768,
-            steps=4,
-            n=1,
-            response_format="b64_json"
-        )
+        response = provider('together').call(lambda timeout: _flux_images('together', timeout).generate(
+            prompt=f"A scene depicting: {prompt}", **FLUX_REQUEST
+        ))
         logging.info("Image generated successfully")
         
         image_data = response.data[0].b64_json
-        image = Image.open(BytesIO(base64.b64decode(image_data)))
-        
-        # Save the image to a file in the static/images directory
-        image_filename = f"generated_image_{int(time.time())}_{hash(prompt)}.png"
-        image_path = os.path.join('static', 'images', image_filename)
-        image.save(image_path)
-        logging.info(f"Image saved to {image_path}")
-        
-        return f"/static/images/{image_filename}"
+        return store_image(base64.b64decode(image_data))
+    except Exception as e:
+        logging.error(f"Flux API error: {e}")
+        return None
+
+async def get_flux_image_async(prompt):
+    try:
+        logging.info(f"Generating image for prompt: {prompt}")
+        response = await provider('together').call_async(lambda timeout: _flux_images('together_async', timeout).generate(
+            prompt=f"A scene depicting: {prompt}", **FLUX_REQUEST
+        ))
+        image_data = response.data[0].b64_json
+        # Decoding and resizing are CPU-bound; keep them off the event loop
+        return await asyncio.to_thread(store_image, base64.b64decode(image_data))
     except Exception as e:
         logging.error(f"Flux API error: {e}")
         return None
 
-def generate_images_for_paragraphs(paragraphs):
+PLACEHOLDER_IMAGE = "/static/images/placeholder.svg"
+
+def generate_images_for_paragraphs(paragraphs, story_id=None):
     logging.info(f"Generating images for {len(paragraphs)} paragraphs")
     for i, paragraph in enumerate(paragraphs):
         logging.info(f"Generating image for paragraph {i + 1}")
-        image_url = get_flux_image(paragraph['content'])
-        if image_url:
-            paragraph['image_url'] = image_url
-            logging.info(f"Image URL set for paragraph {i + 1}: {image_url}")
-        else:
-            paragraph['image_url'] = "/static/images/placeholder.svg"
-            logging.warning(f"Using placeholder image for paragraph {i + 1}")
+        paragraph['image_url'] = generate_image_for_paragraph(paragraph['content'], story_id)
     return paragraphs
 
 def extract_keywords(scene_content):
-    words = scene_content.split()
-    keywords = [word for word in words if len(word) > 5][:5]
-    return " ".join(keywords)
+    return distill_image_prompt(scene_content, max_words=5)
 
-def generate_image_for_paragraph(paragraph_content):
+# Images are drawn from a distilled prompt rather than the raw paragraph.
+# Within a story (`story_id` given), a paragraph whose prompt is close enough
+# to an earlier one reuses that image instead of calling FLUX again.
+def generate_image_for_paragraph(paragraph_content, story_id=None):
     logging.info(f"Generating image for paragraph: {paragraph_content[:50]}...")
-    image_url = get_flux_image(paragraph_content)
-    if image_url:
-        logging.info(f"Image generated successfully: {image_url}")
-        return image_url
-    else:
+    prompt = distill_image_prompt(paragraph_content)
+    signature = prompt_signature(prompt) if story_id is not None else None
+    if signature:
+        image_url = find_similar_image(story_id, prompt, signature)
+        if image_url:
+            image_reuse.inc(outcome='reused')
+            return image_url
+    image_url = get_flux_image(prompt or paragraph_content)
+    if not image_url:
+        logging.warning("Failed to generate image, using placeholder")
+        return PLACEHOLDER_IMAGE
+    logging.info(f"Image generated successfully: {image_url}")
+    if signature:
+        image_reuse.inc(outcome='generated')
+        remember_image(story_id, prompt, signature, image_url)
+    return image_url
+
+# `run(fn, *args)` awaits fn in a worker thread with an app context; it is
+# needed for the reuse lookups, which read the database.
+async def generate_image_for_paragraph_async(paragraph_content, story_id=None, run=None):
+    prompt = distill_image_prompt(paragraph_content)
+    signature = prompt_signature(prompt) if story_id is not None and run else None
+    if signature:
+        image_url = await run(find_similar_image, story_id, prompt, signature)
+        if image_url:
+            image_reuse.inc(outcome='reused')
+            return image_url
+    image_url = await get_flux_image_async(prompt or paragraph_content)
+    if not image_url:
         logging.warning("Failed to generate image, using placeholder")
-        return "/static/images/placeholder.svg"
\ No newline at end of file
+        return PLACEHOLDER_IMAGE
+    logging.info(f"Image generated successfully: {image_url}")
+    if signature:
+        image_reuse.inc(outcome='generated')
+        await run(remember_image, story_id, prompt, signature, image_url)
+    return image_url
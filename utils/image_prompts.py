@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import re
+import struct
+from sqlalchemy import select, insert
+from config import Config
+from models import db, ImagePrompt
+from utils.media_store import media_path
+from utils.metrics import image_prompt_similarity
+
+logging.basicConfig(level=logging.INFO)
+
+# Dialogue says little about what a scene looks like, and most of a
+# paragraph's words are glue. A distilled prompt keeps the narration's
+# content words in order, so paragraphs describing the same setting map to
+# nearly the same prompt.
+DIALOGUE = re.compile(r'"[^"]*"|“[^”]*”')
+WORD = re.compile(r"[A-Za-z][A-Za-z'-]*")
+
+STOPWORDS = frozenset('''
+a about above after again against all almost also although am an and another any are around as at away back be
+because been before being below between both but by can could did do does doing done down during each either
+even ever every few for from further had has have having he her here hers herself him himself his how however
+i if in into is it its itself just least less like made make many may me might more most much must my myself
+never next no nor not now of off often on once one only onto or other our ours ourselves out over own perhaps
+quite rather really said same say says seemed seems she should since so some something still such than that the
+their theirs them themselves then there these they thing things this those though through thus to too toward
+towards under until up upon us very was we were what whatever when where whether which while who whom whose why
+will with within without would yet you your yours yourself asked answered replied whispered told thought knew
+felt looked turned began let get got going went come came
+'''.split())
+
+PERMUTATIONS = 64
+MERSENNE = (1 << 61) - 1
+SIGNATURE = struct.Struct(f'<{PERMUTATIONS}Q')
+
+def _content_words(text):
+    words = []
+    seen = set()
+    for word in WORD.findall(text):
+        key = word.lower().removesuffix("'s").strip("'-")
+        if len(key) < 3 or key in STOPWORDS or key in seen:
+            continue
+        seen.add(key)
+        words.append(word.removesuffix("'s"))
+    return words
+
+# Reduces a paragraph to a compact visual description: its narration's
+# content words, falling back to the dialogue for paragraphs that are all
+# speech.
+def distill_image_prompt(text, max_words=None):
+    words = _content_words(DIALOGUE.sub(' ', text)) or _content_words(text)
+    return ' '.join(words[:max_words or Config.IMAGE_PROMPT_WORDS])
+
+# MinHash over the prompt's words: the fraction of equal positions in two
+# signatures estimates the Jaccard similarity of their word sets. The hashes
+# come from blake2b so signatures stay comparable across processes.
+def prompt_signature(prompt):
+    tokens = {word.lower() for word in prompt.split()}
+    if not tokens:
+        return None
+    minimums = [MERSENNE] * PERMUTATIONS
+    for token in tokens:
+        digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(PERMUTATIONS):
+            value = (first + i * step) % MERSENNE
+            if value < minimums[i]:
+                minimums[i] = value
+    return minimums
+
+def similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / PERMUTATIONS
+
+# Returns the image of the story's most similar recent prompt when it clears
+# IMAGE_REUSE_THRESHOLD and the file still exists, else None. These run on
+# media worker threads, so they use engine connections rather than the
+# scoped session.
+def find_similar_image(story_id, prompt, signature):
+    if signature is None or Config.IMAGE_REUSE_THRESHOLD <= 0:
+        return None
+    query = (select(ImagePrompt.signature, ImagePrompt.image_url)
+             .where(ImagePrompt.story_id == story_id)
+             .order_by(ImagePrompt.id.desc())
+             .limit(Config.IMAGE_REUSE_WINDOW))
+    best, best_url = 0.0, None
+    with db.engine.connect() as connection:
+        for packed, image_url in connection.execute(query):
+            score = similarity(signature, SIGNATURE.unpack(packed))
+            if score > best and media_path(image_url):
+                best, best_url = score, image_url
+    image_prompt_similarity.observe(best)
+    if best >= Config.IMAGE_REUSE_THRESHOLD:
+        logging.info(f"Reusing image {best_url} for story {story_id} (similarity {best:.2f}): {prompt}")
+        return best_url
+    return None
+
+def remember_image(story_id, prompt, signature, image_url):
+    if signature is None:
+        return
+    with db.engine.begin() as connection:
+        connection.execute(insert(ImagePrompt).values(
+            story_id=story_id, prompt=prompt, signature=SIGNATURE.pack(*signature), image_url=image_url
+        ))
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from config import Config
+from utils.providers import ProviderUnavailable
+from utils.metrics import llm_cache_requests, llm_prompt_chars, llm_response_chars
+
+logging.basicConfig(level=logging.INFO)
+
+# Content-addressed store for LLM responses. Entries live in a SQLite file so
+# every worker process shares the same cache; SQLite's own file locking makes
+# concurrent readers and writers safe.
+class LLMCache:
+    def __init__(self, path, max_bytes, max_age, evict_every=50):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model, system_prompt, prompt, params=None):
+        payload = json.dumps([model, system_prompt or '', prompt, params or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key, allow_stale=False):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            'SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or (now - row[1] > self.max_age and not allow_stale):
+            with self._lock:
+                self.misses += 1
+            return None
+        conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def set(self, key, model, response):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, model, response, len(response.encode('utf-8')), now, now)
+        )
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            expired = conn.execute(
+                'DELETE FROM llm_cache WHERE created_at < ?', (time.time() - self.max_age,)
+            ).rowcount
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                rows = conn.execute('SELECT key, size FROM llm_cache ORDER BY accessed_at').fetchall()
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                conn.executemany('DELETE FROM llm_cache WHERE key = ?', stale)
+                evicted = len(stale)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if expired or evicted:
+            logging.info(f"LLM cache evicted {expired} expired and {evicted} least recently used entries")
+
+    def stats(self):
+        conn = self._connection()
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+llm_cache = LLMCache(Config.LLM_CACHE_PATH, Config.LLM_CACHE_MAX_BYTES, Config.LLM_CACHE_MAX_AGE)
+
+# `parse(response)`, if given, turns the response into the value returned and
+# raises when it is malformed. Only responses it accepts are cached, and a
+# cached one it rejects counts as a miss and is replaced.
+def cached_completion(model, system_prompt, prompt, params, call, use_cache=True, parse=None):
+    parse = parse or (lambda response: response)
+    llm_prompt_chars.observe(len(system_prompt or '') + len(prompt), model=model)
+    if not (use_cache and Config.LLM_CACHE_ENABLED):
+        return parse(_observed(model, call()))
+    key = llm_cache.make_key(model, system_prompt, prompt, params)
+    try:
+        cached = llm_cache.get(key)
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache read failed: {e}")
+        return parse(_observed(model, call()))
+    if cached is not None:
+        try:
+            parsed = parse(cached)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Discarding invalid cached {model} response: {e}")
+        else:
+            logging.info(f"LLM cache hit for {model}")
+            llm_cache_requests.inc(model=model, result='hit')
+            return parsed
+    llm_cache_requests.inc(model=model, result='miss')
+    try:
+        response = _observed(model, call())
+    except ProviderUnavailable:
+        stale = _stale_entry(key)
+        if stale is None:
+            raise
+        logging.warning(f"{model} unavailable, serving expired cache entry")
+        llm_cache_requests.inc(model=model, result='stale')
+        return parse(stale)
+    parsed = parse(response)
+    try:
+        llm_cache.set(key, model, response)
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache write failed: {e}")
+    return parsed
+
+def _observed(model, response):
+    llm_response_chars.observe(len(response or ''), model=model)
+    return response
+
+def _stale_entry(key):
+    try:
+        return llm_cache.get(key, allow_stale=True)
+    except sqlite3.Error:
+        return None
+
+# Streaming variant: a hit replays the cached response as a single chunk, a
+# miss passes the provider's chunks through and caches the joined text once
+# the stream has been fully consumed.
+def cached_stream(model, system_prompt, prompt, params, stream_call, use_cache=True):
+    llm_prompt_chars.observe(len(system_prompt or '') + len(prompt), model=model)
+    if not (use_cache and Config.LLM_CACHE_ENABLED):
+        yield from _observed_stream(model, stream_call())
+        return
+    key = llm_cache.make_key(model, system_prompt, prompt, params)
+    try:
+        cached = llm_cache.get(key)
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        logging.info(f"LLM cache hit for {model}")
+        llm_cache_requests.inc(model=model, result='hit')
+        yield cached
+        return
+    llm_cache_requests.inc(model=model, result='miss')
+    chunks = []
+    for chunk in _observed_stream(model, stream_call()):
+        chunks.append(chunk)
+        yield chunk
+    try:
+        llm_cache.set(key, model, ''.join(chunks))
+    except sqlite3.Error as e:
+        logging.error(f"LLM cache write failed: {e}")
+
+# asyncio counterpart of cached_stream: cache reads and writes run in worker
+# threads and `stream_call` returns an async iterator of text chunks.
+async def cached_stream_async(model, system_prompt, prompt, params, stream_call, use_cache=True):
+    llm_prompt_chars.observe(len(system_prompt or '') + len(prompt), model=model)
+    key = None
+    if use_cache and Config.LLM_CACHE_ENABLED:
+        key = llm_cache.make_key(model, system_prompt, prompt, params)
+        try:
+            cached = await asyncio.to_thread(llm_cache.get, key)
+        except sqlite3.Error as e:
+            logging.error(f"LLM cache read failed: {e}")
+            cached = None
+        if cached is not None:
+            logging.info(f"LLM cache hit for {model}")
+            llm_cache_requests.inc(model=model, result='hit')
+            yield cached
+            return
+        llm_cache_requests.inc(model=model, result='miss')
+    chunks = []
+    async for chunk in await stream_call():
+        chunks.append(chunk)
+        yield chunk
+    response = ''.join(chunks)
+    llm_response_chars.observe(len(response), model=model)
+    if key is not None:
+        try:
+            await asyncio.to_thread(llm_cache.set, key, model, response)
+        except sqlite3.Error as e:
+            logging.error(f"LLM cache write failed: {e}")
+
+def _observed_stream(model, chunks):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    llm_response_chars.observe(size, model=model)
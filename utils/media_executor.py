@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from utils.image_generator import PLACEHOLDER_IMAGE, generate_image_for_paragraph, generate_image_for_paragraph_async
+from utils.text_to_speech import generate_audio_for_scene, generate_audio_for_scene_async
+
+logging.basicConfig(level=logging.INFO)
+
+# One pool per provider so the pool size doubles as the provider's
+# concurrency cap, shared by every scene generated in this process.
+image_pool = ThreadPoolExecutor(max_workers=Config.IMAGE_CONCURRENCY, thread_name_prefix='flux')
+audio_pool = ThreadPoolExecutor(max_workers=Config.AUDIO_CONCURRENCY, thread_name_prefix='tts')
+
+# Fans out image and audio generation for the paragraphs of one scene and
+# hands back each paragraph as soon as both of its media are ready. With a
+# `story_id`, images can be reused from similar paragraphs of that story.
+class MediaBatch:
+    def __init__(self, story_id=None):
+        self.story_id = story_id
+        self._completed = queue.Queue()
+        self._pending = 0
+
+    def submit(self, index, content):
+        paragraph = {'content': content}
+        # Each task runs in a copy of the caller's context so its spans are
+        # attributed to the scene and request that submitted it.
+        image_future = image_pool.submit(contextvars.copy_context().run, generate_image_for_paragraph, content, self.story_id)
+        audio_future = audio_pool.submit(contextvars.copy_context().run, generate_audio_for_scene, content)
+        remaining = [2]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            paragraph['image_url'] = _result_or(image_future, PLACEHOLDER_IMAGE, index, 'image')
+            paragraph['audio_url'] = _result_or(audio_future, None, index, 'audio')
+            self._completed.put((index, paragraph))
+
+        self._pending += 1
+        image_future.add_done_callback(on_done)
+        audio_future.add_done_callback(on_done)
+
+    def ready(self):
+        # Non-blocking: only the paragraphs that have already finished.
+        while self._pending:
+            try:
+                item = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            self._pending -= 1
+            yield item
+
+    def as_completed(self):
+        while self._pending:
+            item = self._completed.get()
+            self._pending -= 1
+            yield item
+
+# asyncio counterpart of MediaBatch for the ASGI serving path: each paragraph
+# is a task on the event loop instead of two pool threads, so the number of
+# scenes in flight is bounded by provider limits rather than by threads.
+# `run(fn, *args)` awaits database work in an app context (see run_in_app).
+class AsyncMediaBatch:
+    def __init__(self, story_id=None, run=None):
+        self.story_id = story_id
+        self.run = run
+        self._completed = asyncio.Queue()
+        self._pending = 0
+        self._tasks = set()
+
+    def submit(self, index, content):
+        self._pending += 1
+        task = asyncio.create_task(self._generate(index, content))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _generate(self, index, content):
+        image, audio = await asyncio.gather(
+            generate_image_for_paragraph_async(content, self.story_id, self.run),
+            generate_audio_for_scene_async(content),
+            return_exceptions=True
+        )
+        paragraph = {
+            'content': content,
+            'image_url': _value_or(image, PLACEHOLDER_IMAGE, index, 'image'),
+            'audio_url': _value_or(audio, None, index, 'audio')
+        }
+        await self._completed.put((index, paragraph))
+
+    def ready(self):
+        while self._pending and not self._completed.empty():
+            self._pending -= 1
+            yield self._completed.get_nowait()
+
+    async def as_completed(self):
+        while self._pending:
+            item = await self._completed.get()
+            self._pending -= 1
+            yield item
+
+def _value_or(value, default, index, kind):
+    if isinstance(value, BaseException):
+        logging.error(f"Failed to generate {kind} for paragraph {index + 1}: {value}")
+        return default
+    return value or default
+
+def _result_or(future, default, index, kind):
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Failed to generate {kind} for paragraph {index + 1}: {error}")
+        return default
+    return future.result() or default
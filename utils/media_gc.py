@@ -0,0 +1,201 @@
+import logging
+import os
+import re
+import shutil
+import time
+from sqlalchemy import select, update, func
+from config import Config
+from models import db, User, Story, Scene, Paragraph
+from utils.media_store import media_path
+
+logging.basicConfig(level=logging.INFO)
+
+MEDIA_KINDS = ('images', 'audio')
+# Shipped with the app rather than generated; never collected
+KEEP = {'placeholder.svg'}
+
+THUMBNAIL_NAME = re.compile(r'^([0-9a-f]{32})_\d+\.(\w+)$')
+EXPORT_NAME = re.compile(r'^story_(\d+)_[0-9a-f]+\.(\w+)$')
+
+class QuotaExceeded(Exception):
+    pass
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Refuses new generations once the user, or the installation as a whole, is
+# over its storage quota. Usage is what the last collection run measured, so
+# this costs one query instead of a walk over the media folders.
+def check_media_quota(user_id):
+    if Config.MEDIA_QUOTA_PER_USER:
+        used = db.session.query(User.media_bytes).filter_by(id=user_id).scalar() or 0
+        if used >= Config.MEDIA_QUOTA_PER_USER:
+            raise QuotaExceeded(f"Your media storage quota is used up ({format_bytes(used)} of {format_bytes(Config.MEDIA_QUOTA_PER_USER)}).")
+    if Config.MEDIA_QUOTA_TOTAL:
+        used = db.session.query(func.sum(User.media_bytes)).scalar() or 0
+        if used >= Config.MEDIA_QUOTA_TOTAL:
+            raise QuotaExceeded("Media storage is full; new scenes cannot be generated right now.")
+
+# Mark phase: every stored file some paragraph (or a legacy scene column)
+# refers to, mapped to the users whose stories refer to it. Legacy JSON in
+# Scene.content is not read, so it has to be migrated into Paragraph rows
+# (recreate_db.py) before anything is collected.
+def mark():
+    if db.session.query(Scene.id).filter(Scene.content != '').first():
+        raise RuntimeError("Some scenes still keep their paragraphs in Scene.content; run recreate_db.py first")
+    references = {}
+    queries = [
+        select(Story.user_id, Paragraph.image_url, Paragraph.audio_url).join(Scene, Paragraph.scene_id == Scene.id).join(Story, Scene.story_id == Story.id),
+        select(Story.user_id, Scene.image_url, Scene.audio_url).join(Story, Scene.story_id == Story.id),
+    ]
+    for query in queries:
+        for user_id, *urls in db.session.execute(query.execution_options(yield_per=1000)):
+            for url in urls:
+                path = media_path(url)
+                if path:
+                    references.setdefault(os.path.abspath(path), set()).add(user_id)
+    return references
+
+def _media_files():
+    seen = set()
+    for root in (Config.MEDIA_ROOT, 'static'):
+        for kind in MEDIA_KINDS:
+            directory = os.path.abspath(os.path.join(root, kind))
+            if directory in seen or not os.path.isdir(directory):
+                continue
+            seen.add(directory)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        yield kind, entry.path, entry.stat(follow_symlinks=False)
+
+# Cached exports are superseded whenever the story changes; only the newest
+# file per story and format is worth keeping, and none for deleted stories.
+def _stale_exports(cutoff):
+    directory = os.path.abspath(Config.EXPORT_CACHE_PATH)
+    if not os.path.isdir(directory):
+        return []
+    story_ids = {story_id for story_id, in db.session.query(Story.id)}
+    exports = {}
+    stale = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            match = EXPORT_NAME.match(entry.name)
+            if match and int(match.group(1)) in story_ids:
+                exports.setdefault(match.groups(), []).append(('exports', entry.path, stat))
+            elif stat.st_mtime < cutoff:
+                stale.append(('exports', entry.path, stat))
+    for versions in exports.values():
+        versions.sort(key=lambda version: version[2].st_mtime)
+        stale += [version for version in versions[:-1] if version[2].st_mtime < cutoff]
+    return stale
+
+# Cached sentence audio is refreshed on every hit; entries nothing has used
+# for TTS_CACHE_MAX_AGE go.
+def _stale_sentences(now):
+    directory = os.path.abspath(Config.TTS_CACHE_PATH)
+    if not os.path.isdir(directory):
+        return []
+    stale = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime < now - Config.TTS_CACHE_MAX_AGE:
+                    stale.append(('tts_cache', entry.path, stat))
+    return stale
+
+def _remove(kind, path, archive):
+    try:
+        if archive:
+            target = os.path.join(archive, kind)
+            os.makedirs(target, exist_ok=True)
+            shutil.move(path, os.path.join(target, os.path.basename(path)))
+        else:
+            os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _tally(totals, kind, size):
+    files, total = totals.get(kind, (0, 0))
+    totals[kind] = (files + 1, total + size)
+
+# Mark and sweep over the media folders. Unreferenced files are only
+# collected once they are older than `grace` seconds: a generation writes its
+# media before committing the paragraphs that refer to them, and prefetched
+# drafts keep theirs in memory for a while. When the stored media exceed
+# MEDIA_QUOTA_TOTAL, younger orphans down to MEDIA_GC_MIN_GRACE go as well,
+# oldest first. Collected files are deleted, or moved under `archive`.
+def collect_garbage(grace=None, archive=None, dry_run=False):
+    grace = Config.MEDIA_GC_GRACE if grace is None else grace
+    now = time.time()
+    cutoff = now - grace
+    references = mark()
+
+    files = list(_media_files())
+    names = {path: stat for _, path, stat in files}
+    stored = {}
+    orphans = []
+    for kind, path, stat in files:
+        _tally(stored, kind, stat.st_size)
+        name = os.path.basename(path)
+        if name in KEEP or path in references:
+            continue
+        # Thumbnails live and die with their full-size image
+        thumbnail = THUMBNAIL_NAME.match(name)
+        if thumbnail:
+            full = os.path.join(os.path.dirname(path), f"{thumbnail.group(1)}.{thumbnail.group(2)}")
+            if full in references or (full in names and names[full].st_mtime >= cutoff):
+                continue
+        orphans.append((kind, path, stat))
+
+    collect = [orphan for orphan in orphans if orphan[2].st_mtime < cutoff]
+    total_bytes = sum(size for _, size in stored.values())
+    remaining = total_bytes - sum(stat.st_size for _, _, stat in collect)
+    if Config.MEDIA_QUOTA_TOTAL and remaining > Config.MEDIA_QUOTA_TOTAL:
+        min_cutoff = now - Config.MEDIA_GC_MIN_GRACE
+        for orphan in sorted(orphans, key=lambda orphan: orphan[2].st_mtime):
+            if remaining <= Config.MEDIA_QUOTA_TOTAL or orphan[2].st_mtime >= min_cutoff:
+                break
+            if orphan[2].st_mtime >= cutoff:
+                collect.append(orphan)
+                remaining -= orphan[2].st_size
+    collect += _stale_exports(cutoff)
+    collect += _stale_sentences(now)
+
+    reclaimed = {}
+    for kind, path, stat in collect:
+        if dry_run or _remove(kind, path, archive):
+            _tally(reclaimed, kind, stat.st_size)
+
+    usage = {}
+    for path, user_ids in references.items():
+        stat = names.get(path)
+        size = stat.st_size if stat else os.path.getsize(path)
+        for user_id in user_ids:
+            usage[user_id] = usage.get(user_id, 0) + size
+    measured = [{'id': user_id, 'media_bytes': usage.get(user_id, 0)} for user_id, in db.session.query(User.id)]
+    if measured and not dry_run:
+        db.session.execute(update(User), measured)
+        db.session.commit()
+
+    report = {
+        'dry_run': dry_run,
+        'archive': archive,
+        'stored': {kind: {'files': count, 'bytes': size} for kind, (count, size) in stored.items()},
+        'orphaned': len(orphans),
+        'reclaimed': {kind: {'files': count, 'bytes': size} for kind, (count, size) in reclaimed.items()},
+        'reclaimed_bytes': sum(size for _, size in reclaimed.values()),
+        'total_bytes': total_bytes - sum(size for kind, (_, size) in reclaimed.items() if kind in MEDIA_KINDS),
+        'over_quota_users': sorted(user_id for user_id, size in usage.items() if Config.MEDIA_QUOTA_PER_USER and size >= Config.MEDIA_QUOTA_PER_USER),
+    }
+    report['over_total_quota'] = bool(Config.MEDIA_QUOTA_TOTAL) and report['total_bytes'] > Config.MEDIA_QUOTA_TOTAL
+    logging.info(f"Media collection {'(dry run) ' if dry_run else ''}reclaimed {format_bytes(report['reclaimed_bytes'])} from {sum(count for count, _ in reclaimed.values())} files")
+    return report
@@ -0,0 +1,137 @@
+import hashlib
+import logging
+import os
+import tempfile
+from io import BytesIO
+from config import Config
+from utils.metrics import span, image_bytes, audio_bytes, media_dedup
+
+logging.basicConfig(level=logging.INFO)
+
+# Width of the images requested from FLUX; used for the full-size srcset entry.
+FULL_IMAGE_WIDTH = 1024
+
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'webp', {'method': 4}),
+    'avif': ('AVIF', 'avif', {'speed': 6}),
+    'jpeg': ('JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+}
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def _media_dir(kind):
+    path = os.path.join(Config.MEDIA_ROOT, kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _url(kind, filename):
+    return f"/static/{kind}/{filename}"
+
+# Maps a stored media URL (/static/<kind>/<file>) back to the file on disk,
+# looking in MEDIA_ROOT first and the legacy static folder second. External
+# URLs and anything escaping those folders map to None.
+def media_path(url):
+    if not url or not url.startswith('/static/'):
+        return None
+    parts = url[len('/static/'):].split('/')
+    if '..' in parts:
+        return None
+    for root in (Config.MEDIA_ROOT, 'static'):
+        path = os.path.join(root, *parts)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# A reused file may be old enough for the media collector to consider it, but
+# its new reference is not committed yet; refreshing the mtime puts it back
+# inside the collector's grace period.
+def _reuse(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def store_blob(data, kind, extension):
+    filename = f"{content_digest(data)}.{extension}"
+    path = os.path.join(_media_dir(kind), filename)
+    if os.path.exists(path):
+        logging.info(f"Reusing stored {kind} blob {filename}")
+        media_dedup.inc(kind=kind)
+        _reuse(path)
+    else:
+        _write_atomic(path, data)
+        if kind == 'audio':
+            audio_bytes.observe(len(data))
+    return _url(kind, filename)
+
+def _image_format():
+    from PIL import features
+    name = Config.IMAGE_FORMAT
+    if name == 'avif' and not features.check('avif'):
+        logging.warning("AVIF encoding is not available in this Pillow build, falling back to WebP")
+        name = 'webp'
+    return IMAGE_FORMATS.get(name, IMAGE_FORMATS['webp'])
+
+def _encode(image, pil_format, options):
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    with span('image_encode'):
+        image.save(buffer, format=pil_format, quality=Config.IMAGE_QUALITY, **options)
+    image_bytes.observe(buffer.tell(), format=pil_format.lower(), width=str(image.width))
+    return buffer.getvalue()
+
+# Images are keyed by the digest of the provider's original bytes, so the
+# same source image maps to the same files whatever the output format. The
+# full-size image and one thumbnail per configured width share that digest.
+def store_image(source_bytes):
+    from PIL import Image
+    pil_format, extension, options = _image_format()
+    digest = content_digest(source_bytes)
+    directory = _media_dir('images')
+    filename = f"{digest}.{extension}"
+    path = os.path.join(directory, filename)
+    if os.path.exists(path):
+        logging.info(f"Reusing stored image {filename}")
+        media_dedup.inc(kind='images')
+        _reuse(path)
+        return _url('images', filename)
+
+    image = Image.open(BytesIO(source_bytes))
+    image.load()
+    for width in Config.IMAGE_THUMBNAIL_WIDTHS:
+        if width >= image.width:
+            continue
+        height = round(image.height * width / image.width)
+        thumbnail = image.resize((width, height), Image.LANCZOS)
+        _write_atomic(os.path.join(directory, f"{digest}_{width}.{extension}"), _encode(thumbnail, pil_format, options))
+    encoded = _encode(image, pil_format, options)
+    _write_atomic(path, encoded)
+    logging.info(f"Image saved to {path} ({len(encoded)} bytes, source {len(source_bytes)} bytes)")
+    return _url('images', filename)
+
+def image_srcset(image_url):
+    if not image_url:
+        return ''
+    directory, _, filename = image_url.rpartition('/')
+    digest, dot, extension = filename.partition('.')
+    entries = []
+    for width in Config.IMAGE_THUMBNAIL_WIDTHS:
+        if os.path.exists(os.path.join(_media_dir('images'), f"{digest}_{width}.{extension}")):
+            entries.append(f"{directory}/{digest}_{width}.{extension} {width}w")
+    if not entries:
+        return ''
+    return ', '.join(entries + [f"{image_url} {FULL_IMAGE_WIDTH}w"])
@@ -0,0 +1,173 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+stage_seconds = Histogram('storygen_stage_seconds', 'Wall time of each pipeline stage')
+stage_errors = Counter('storygen_stage_errors_total', 'Pipeline stages that raised')
+llm_prompt_chars = Histogram('storygen_llm_prompt_chars', 'Characters sent to LLMs per call', (500, 1000, 2000, 4000, 8000, 16000, 32000))
+llm_response_chars = Histogram('storygen_llm_response_chars', 'Characters received from LLMs per call', (500, 1000, 2000, 4000, 8000, 16000, 32000))
+llm_cache_requests = Counter('storygen_llm_cache_requests_total', 'LLM cache lookups by result')
+image_bytes = Histogram('storygen_image_bytes', 'Encoded size of stored images', SIZE_BUCKETS)
+audio_bytes = Histogram('storygen_audio_bytes', 'Size of stored audio files', SIZE_BUCKETS)
+media_dedup = Counter('storygen_media_dedup_total', 'Media writes skipped because the blob already existed')
+scenes_generated = Counter('storygen_scenes_generated_total', 'Scenes checkpointed as generated')
+image_reuse = Counter('storygen_image_reuse_total', 'Paragraph images by whether a similar earlier image was reused')
+tts_sentences = Counter('storygen_tts_sentences_total', 'Sentences of paragraph audio by whether they were synthesized or served from the cache')
+image_prompt_similarity = Histogram('storygen_image_prompt_similarity', 'Best similarity of a new image prompt to earlier prompts of the same story', (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+
+METRICS = [stage_seconds, stage_errors, llm_prompt_chars, llm_response_chars, llm_cache_requests,
+           image_bytes, audio_bytes, media_dedup, scenes_generated, image_reuse, image_prompt_similarity,
+           tts_sentences]
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+def expose():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+# Story/scene identifiers of the work running in this context, appended to
+# the span debug log lines; copied into worker threads by MediaBatch so spans
+# there carry them too. The timing trailer names its scene itself.
+trace_ids = contextvars.ContextVar('trace_ids', default={})
+# Per-request accumulator behind the optional NDJSON timing trailer.
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+@contextmanager
+def trace(**ids):
+    token = trace_ids.set({**trace_ids.get(), **ids})
+    try:
+        yield
+    finally:
+        trace_ids.reset(token)
+
+@contextmanager
+def collect_timings():
+    timings = {}
+    token = request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        request_timings.reset(token)
+
+def record(stage, elapsed, failed=False):
+    stage_seconds.observe(elapsed, stage=stage)
+    if failed:
+        stage_errors.inc(stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        with _timings_lock:
+            entry = timings.setdefault(stage, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] = round(entry['seconds'] + elapsed, 4)
+    ids = ' '.join(f"{k}={v}" for k, v in trace_ids.get().items())
+    logging.debug(f"span {stage} {elapsed * 1000:.1f}ms {ids}{' failed' if failed else ''}")
+
+_timings_lock = threading.Lock()
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record(stage, time.perf_counter() - started, failed)
+
+_instrumented = False
+
+# Times every ORM commit in the process as the db_commit stage.
+def instrument_sqlalchemy():
+    global _instrumented
+    if _instrumented:
+        return
+    _instrumented = True
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session as session_class
+
+    @event.listens_for(session_class, 'before_commit')
+    def before_commit(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(session_class, 'after_commit')
+    def after_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            record('db_commit', time.perf_counter() - started)
+
+    @event.listens_for(session_class, 'after_rollback')
+    def after_rollback(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            record('db_commit', time.perf_counter() - started, failed=True)
@@ -0,0 +1,172 @@
+import json
+import re
+
+ACT_PATTERN = re.compile(r'^\W*Act\s+(\d+|[IVX]+)[A-Z]?\b\s*[:\-–—.]?\s*(.*)$', re.IGNORECASE)
+CHAPTER_PATTERN = re.compile(r'^\W*Chapter\s+(\d+)\b\s*[:\-–—.]?\s*(.*)$', re.IGNORECASE)
+CHARACTER_HEADING_PATTERN = re.compile(r'^[#*\s]*[\w\s]*Character[\w\s]*:?[*\s]*:?\s*$', re.IGNORECASE)
+STRUCTURE_HEADING_PATTERN = re.compile(r'^[#*\s]*[\w\s-]*\b(Structure|Outline|Breakdown)\b[\w\s-]*:?[*\s]*:?\s*$', re.IGNORECASE)
+BOLD_NAME_PATTERN = re.compile(r'^\*\*([^*]+?)\*\*\s*:?\s*(.*)$')
+HEADING_NAME_PATTERN = re.compile(r'^(?:#+\s*|\d+\.\s*)?(?:\*\*([^*]+?)\*\*|(?<=#\s)(.+))\s*:?\s*(.*)$')
+BULLET_PATTERN = re.compile(r'^\s*[*\-+•]\s+')
+ROMAN_NUMERALS = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6, 'VII': 7, 'VIII': 8, 'IX': 9, 'X': 10}
+NAME_TITLES = {'dr', 'mr', 'mrs', 'ms', 'miss', 'sir', 'lady', 'lord', 'the', 'captain', 'professor', 'prof'}
+
+def _clean(text):
+    text = BULLET_PATTERN.sub('', text)
+    return ' '.join(text.replace('**', '').replace('__', '').split()).strip(' :')
+
+def _act_number(label):
+    return int(label) if label.isdigit() else ROMAN_NUMERALS.get(label.upper(), 0)
+
+def _append(entry, key, line):
+    text = _clean(line)
+    if text:
+        entry[key] = f"{entry[key]} {text}".strip()
+
+# Turns the free-form outline the StoryStructureAgent writes into
+# {"acts": [{"number", "title", "summary", "chapters": [{"number", "label",
+# "description"}]}], "characters": [{"name", "profile"}]}. Chapters are
+# numbered by position within their act, which is how scenes address them,
+# even when the outline numbers chapters across the whole book.
+def parse_outline(outline):
+    acts = []
+    character_lines = []
+    act = chapter = None
+    in_characters = False
+    for raw_line in (outline or '').splitlines():
+        line = raw_line.rstrip()
+        if not line.strip():
+            continue
+        act_match = ACT_PATTERN.match(line)
+        if act_match and len(line) < 120:
+            in_characters = False
+            number = _act_number(act_match.group(1))
+            act = next((a for a in acts if a['number'] == number), None)
+            if act is None:
+                act = {'number': number, 'title': _clean(act_match.group(2)), 'summary': '', 'chapters': []}
+                acts.append(act)
+            chapter = None
+            continue
+        if CHARACTER_HEADING_PATTERN.match(line) and len(line) < 80:
+            in_characters = True
+            continue
+        if STRUCTURE_HEADING_PATTERN.match(line) and len(line) < 80:
+            in_characters = False
+            continue
+        if in_characters:
+            character_lines.append(line)
+            continue
+        chapter_match = CHAPTER_PATTERN.match(line)
+        if chapter_match and act is not None:
+            chapter = {'number': len(act['chapters']) + 1, 'label': int(chapter_match.group(1)), 'description': ''}
+            _append(chapter, 'description', chapter_match.group(2))
+            act['chapters'].append(chapter)
+        elif chapter is not None:
+            _append(chapter, 'description', line)
+        elif act is not None:
+            _append(act, 'summary', line)
+    return {'acts': acts, 'characters': _parse_characters(character_lines)}
+
+# Character sections come either as "**Name**", "### Name" or "1. **Name**"
+# lines followed by bulleted details, or as top-level "* **Name**: profile"
+# bullets with nested details.
+def _heading_entry(line):
+    if BULLET_PATTERN.match(line):
+        return None
+    match = HEADING_NAME_PATTERN.match(line)
+    if not match:
+        return None
+    return match.group(1) or match.group(2), match.group(3)
+
+def _bullet_entry(line):
+    if not re.match(r'^[*\-•]\s', line):
+        return None
+    match = BOLD_NAME_PATTERN.match(BULLET_PATTERN.sub('', line))
+    return (match.group(1), match.group(2)) if match else None
+
+def _parse_characters(lines):
+    heading_style = any(_heading_entry(line) for line in lines)
+    characters = []
+    current = None
+    for line in lines:
+        entry = _heading_entry(line) if heading_style else _bullet_entry(line)
+        if entry:
+            label, profile = entry
+            current = {'name': re.sub(r'\s*\(.*?\)\s*', ' ', label).strip(' :'), 'profile': _clean(profile)}
+            role = re.search(r'\((.*?)\)', label)
+            if role:
+                current['profile'] = f"{role.group(1)}. {current['profile']}".strip()
+            characters.append(current)
+        elif current is not None:
+            _append(current, 'profile', line)
+    return characters
+
+def load_index(outline_index):
+    if not outline_index:
+        return None
+    try:
+        return json.loads(outline_index)
+    except ValueError:
+        return None
+
+def _name_tokens(name):
+    tokens = [t.strip('.,') for t in name.split()]
+    return [t for t in tokens if len(t) > 2 and t.lower().strip('.') not in NAME_TITLES]
+
+def _relevant_characters(characters, text):
+    relevant = []
+    for character in characters:
+        tokens = _name_tokens(character['name'])
+        if any(re.search(rf'\b{re.escape(t)}\b', text) for t in tokens):
+            relevant.append(character)
+    return relevant or characters[:1]
+
+def _chapter_sequence(index):
+    return [(act, chapter) for act in index['acts'] for chapter in act['chapters']]
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit].rsplit(' ', 1)[0] + '...'
+
+# Assembles the prompt context for one chapter: its act, the chapter itself,
+# the chapters either side of it, the characters they mention and compact
+# summaries of the most recent scenes. Returns None when the index does not
+# cover the chapter so callers can fall back to the full outline.
+def build_scene_context(index, act_number, chapter_number, scene_summaries=(), profile_chars=400):
+    if not index or not index.get('acts'):
+        return None
+    sequence = _chapter_sequence(index)
+    position = next((i for i, (act, chapter) in enumerate(sequence)
+                     if act['number'] == act_number and chapter['number'] == chapter_number), None)
+    if position is None:
+        return None
+    act, chapter = sequence[position]
+
+    lines = [f"Act {act['number']}: {act['title']}".rstrip(': ')]
+    if act['summary']:
+        lines.append(act['summary'])
+    neighbours_text = chapter['description']
+    if position > 0:
+        prev_act, prev_chapter = sequence[position - 1]
+        lines.append(f"Previous chapter (Act {prev_act['number']}, Chapter {prev_chapter['number']}): {prev_chapter['description']}")
+        neighbours_text += ' ' + prev_chapter['description']
+    lines.append(f"Current chapter (Act {act['number']}, Chapter {chapter['number']}): {chapter['description']}")
+    if position + 1 < len(sequence):
+        next_act, next_chapter = sequence[position + 1]
+        lines.append(f"Next chapter (Act {next_act['number']}, Chapter {next_chapter['number']}): {next_chapter['description']}")
+        neighbours_text += ' ' + next_chapter['description']
+
+    characters = _relevant_characters(index.get('characters', []), neighbours_text)
+    if characters:
+        lines.append("Characters:")
+        lines.extend(f"- {c['name']}: {_truncate(c['profile'], profile_chars)}" for c in characters)
+    if scene_summaries:
+        lines.append("Story so far:")
+        lines.extend(f"- {summary}" for summary in scene_summaries)
+    return '\n'.join(lines)
+
+def summarize_paragraphs(paragraphs, limit=300):
+    sentences = []
+    for paragraph in (paragraphs[:1] + paragraphs[-1:]) if len(paragraphs) > 1 else paragraphs:
+        sentence = re.split(r'(?<=[.!?])\s', paragraph.strip(), maxsplit=1)[0]
+        sentences.append(sentence)
+    return _truncate(' '.join(sentences), limit)
@@ -0,0 +1,32 @@
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Keyset cursors are the sort key of the last row returned, wrapped in
+# url-safe base64 so clients treat them as opaque.
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(values, list) or len(values) != length or not all(isinstance(v, (str, int)) for v in values):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(value) if value is not None else default
+    except ValueError:
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+# Fetches one row more than requested to tell whether another page exists.
+def keyset_page(query, limit, cursor_of):
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(cursor_of(rows[limit - 1])) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from models import db, Story, Scene
+from utils.story_generator import generate_scene
+from utils.media_executor import MediaBatch
+
+logging.basicConfig(level=logging.INFO)
+
+# Speculative generation of the scenes a reader is about to ask for. Results
+# live in this process only and are never written to the database: the
+# /generate_scene request for the slot consumes them and checkpoints as usual.
+prefetch_pool = ThreadPoolExecutor(max_workers=Config.PREFETCH_WORKERS, thread_name_prefix='prefetch')
+
+_slots = {}
+_last_seen = {}
+_lock = threading.Lock()
+
+class PrefetchSlot:
+    def __init__(self, key):
+        self.key = key
+        self.created_at = time.monotonic()
+        self.cancelled = threading.Event()
+        self.future = None
+
+def touch(story_id):
+    with _lock:
+        _last_seen[story_id] = time.monotonic()
+
+def _abandoned(story_id):
+    return time.monotonic() - _last_seen.get(story_id, 0) > Config.PREFETCH_ABANDON_AFTER
+
+def _sweep():
+    now = time.monotonic()
+    with _lock:
+        for key, slot in list(_slots.items()):
+            expired = slot.future.done() and now - slot.created_at > Config.PREFETCH_TTL
+            if expired or _abandoned(key[0]):
+                slot.cancelled.set()
+                slot.future.cancel()
+                del _slots[key]
+                logging.info(f"Discarded prefetched scene {key}")
+        # Forget readers that left; a story they come back to is simply
+        # touched again
+        live = {key[0] for key in _slots}
+        for story_id in [story_id for story_id in _last_seen if story_id not in live and _abandoned(story_id)]:
+            del _last_seen[story_id]
+
+def schedule_prefetch(app, story_id, depth=None):
+    depth = depth or Config.PREFETCH_DEPTH
+    touch(story_id)
+    _sweep()
+    upcoming = Scene.query.filter_by(story_id=story_id, is_generated=False).order_by(Scene.act, Scene.chapter, Scene.scene_number).limit(depth).all()
+    with _lock:
+        for scene in upcoming:
+            key = (story_id, scene.act, scene.chapter, scene.scene_number)
+            if key in _slots:
+                continue
+            slot = PrefetchSlot(key)
+            slot.future = prefetch_pool.submit(_run, app, slot)
+            _slots[key] = slot
+            logging.info(f"Prefetching scene {key}")
+
+def _stopped(slot):
+    return slot.cancelled.is_set() or _abandoned(slot.key[0])
+
+def _run(app, slot):
+    from utils.scene_pipeline import scene_context
+    story_id, act, chapter, scene_number = slot.key
+    with app.app_context():
+        try:
+            if _stopped(slot):
+                return None
+            story = Story.query.get(story_id)
+            if story is None:
+                return None
+            context = scene_context(story, act, chapter, scene_number)
+            paragraphs = generate_scene(story.book_spec, context, act, chapter, scene_number)
+            media = {}
+            if Config.PREFETCH_MEDIA and not _stopped(slot):
+                batch = MediaBatch(story.id)
+                for i, content in enumerate(paragraphs):
+                    batch.submit(i, content)
+                media = dict(batch.as_completed())
+            return {'paragraphs': paragraphs, 'media': media}
+        finally:
+            db.session.remove()
+
+# Hands over the speculative result for a scene, waiting for it if the
+# prefetch is still running. Returns None when nothing usable was prefetched.
+def take_prefetched(story_id, act, chapter, scene_number):
+    with _lock:
+        slot = _slots.pop((story_id, act, chapter, scene_number), None)
+    if slot is None:
+        return None
+    try:
+        result = slot.future.result()
+    except Exception as e:
+        logging.error(f"Prefetch of scene {slot.key} failed: {e}")
+        return None
+    if result:
+        logging.info(f"Using prefetched scene {slot.key}")
+    return result
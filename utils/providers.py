@@ -0,0 +1,339 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+from utils.metrics import span
+
+logging.basicConfig(level=logging.INFO)
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+SLOT_POLL_INTERVAL = 0.05
+
+class ProviderUnavailable(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes a token if one is available; otherwise returns how long to wait.
+    def _take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, deadline):
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, deadline):
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+# Opens after `threshold` consecutive failures and rejects calls immediately
+# for `reset_after` seconds; then lets a single trial call through and closes
+# again if it succeeds.
+class CircuitBreaker:
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial = None
+        self.lock = threading.Lock()
+
+    # Returns (allowed, trial). A caller handed the half-open trial must pass
+    # it to release_trial once done, whether or not the call got as far as
+    # recording a success or failure.
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True, None
+            if time.monotonic() - self.opened_at < self.reset_after or self.trial is not None:
+                return False, None
+            self.trial = object()
+            return True, self.trial
+
+    # Frees a trial that ended without an outcome (deadline spent waiting
+    # for a slot, cancellation), so the next caller can try again.
+    def release_trial(self, trial):
+        with self.lock:
+            if self.trial is trial:
+                self.trial = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = None
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+def _status_code(error):
+    for attribute in ('status_code', 'code'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+def is_retryable(error):
+    status = _status_code(error)
+    return status is None or status in RETRYABLE_STATUS_CODES
+
+# Every outbound provider call goes through one of these: a token bucket for
+# the request rate, a semaphore for in-flight calls, per-attempt timeouts that
+# never outlive the caller's deadline, jittered exponential backoff between
+# retries and a circuit breaker that fails fast while the provider is down.
+class Provider:
+    def __init__(self, name, rate, burst, concurrency, timeout, deadline, retries, backoff, max_backoff, failure_threshold, reset_after):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_after)
+
+    # `fn` receives the timeout in seconds to apply to this attempt.
+    def call(self, fn, deadline=None):
+        with span(f"provider_{self.name}"):
+            return self._call(fn, deadline)
+
+    # Same contract for the asyncio serving path: `fn` returns an awaitable.
+    # Rate limits, concurrency slots and the breaker are shared with `call`.
+    async def call_async(self, fn, deadline=None):
+        with span(f"provider_{self.name}"):
+            return await self._call_async(fn, deadline)
+
+    # For streamed responses `fn` returns an iterator of chunks. The slot, the
+    # span and the breaker cover the whole stream rather than the handshake,
+    # so reading the stream counts against the concurrency cap and errors in
+    # the middle of it count as failures. Only opening the stream is retried;
+    # chunks already handed on cannot be taken back.
+    def stream(self, fn, deadline=None):
+        with span(f"provider_{self.name}"):
+            deadline = deadline or time.monotonic() + self.deadline
+            attempt = 0
+            while True:
+                trial = self._admit(deadline)
+                try:
+                    self._acquire(deadline)
+                    try:
+                        try:
+                            chunks = iter(fn(self._attempt_timeout(deadline)))
+                        except Exception as e:
+                            delay = self._retry_delay(e, attempt, deadline)
+                            if delay is None:
+                                raise
+                            attempt += 1
+                            time.sleep(delay)
+                            continue
+                        try:
+                            yield from chunks
+                        except Exception as e:
+                            self._record_error(e)
+                            raise
+                    finally:
+                        self.slots.release()
+                    self.breaker.record_success()
+                    return
+                finally:
+                    self.breaker.release_trial(trial)
+
+    # asyncio counterpart of `stream`: `fn` returns an awaitable that
+    # resolves to an async iterator of chunks.
+    async def stream_async(self, fn, deadline=None):
+        with span(f"provider_{self.name}"):
+            deadline = deadline or time.monotonic() + self.deadline
+            attempt = 0
+            while True:
+                trial = self._admit(deadline)
+                try:
+                    await self._acquire_async(deadline)
+                    try:
+                        try:
+                            chunks = await fn(self._attempt_timeout(deadline))
+                        except Exception as e:
+                            delay = self._retry_delay(e, attempt, deadline)
+                            if delay is None:
+                                raise
+                            attempt += 1
+                            await asyncio.sleep(delay)
+                            continue
+                        try:
+                            async for chunk in chunks:
+                                yield chunk
+                        except Exception as e:
+                            self._record_error(e)
+                            raise
+                    finally:
+                        self.slots.release()
+                    self.breaker.record_success()
+                    return
+                finally:
+                    self.breaker.release_trial(trial)
+
+    def _acquire(self, deadline):
+        if not self.bucket.acquire(deadline):
+            raise ProviderUnavailable(f"{self.name} deadline exceeded waiting for rate limit")
+        if not self.slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise ProviderUnavailable(f"{self.name} deadline exceeded waiting for a free slot")
+
+    async def _acquire_async(self, deadline):
+        if not await self.bucket.acquire_async(deadline):
+            raise ProviderUnavailable(f"{self.name} deadline exceeded waiting for rate limit")
+        # Polled so that waiting coroutines never block the event loop
+        while not self.slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                raise ProviderUnavailable(f"{self.name} deadline exceeded waiting for a free slot")
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+
+    def _call(self, fn, deadline):
+        deadline = deadline or time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            trial = self._admit(deadline)
+            try:
+                self._acquire(deadline)
+                try:
+                    result = fn(self._attempt_timeout(deadline))
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                finally:
+                    self.slots.release()
+                self.breaker.record_success()
+                return result
+            finally:
+                self.breaker.release_trial(trial)
+
+    async def _call_async(self, fn, deadline):
+        deadline = deadline or time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            trial = self._admit(deadline)
+            try:
+                await self._acquire_async(deadline)
+                try:
+                    result = await fn(self._attempt_timeout(deadline))
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                finally:
+                    self.slots.release()
+                self.breaker.record_success()
+                return result
+            finally:
+                self.breaker.release_trial(trial)
+
+    # Returns the half-open trial the caller holds, if any.
+    def _admit(self, deadline):
+        if deadline - time.monotonic() <= 0:
+            raise ProviderUnavailable(f"{self.name} deadline exceeded waiting for rate limit")
+        allowed, trial = self.breaker.allow()
+        if not allowed:
+            raise ProviderUnavailable(f"{self.name} circuit is open")
+        return trial
+
+    def _attempt_timeout(self, deadline):
+        return min(self.timeout, max(deadline - time.monotonic(), 0.1))
+
+    def _record_error(self, error):
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            # The provider answered; the request itself was bad
+            self.breaker.record_success()
+
+    # Backoff before the next attempt, or None when the error should be raised.
+    def _retry_delay(self, error, attempt, deadline):
+        self._record_error(error)
+        if not is_retryable(error) or attempt >= self.retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            return None
+        logging.warning(f"{self.name} call failed ({error}), retrying in {delay:.1f}s")
+        return delay
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+def provider(name):
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = Provider(name, **Config.provider_limits(name))
+        return _providers[name]
+
+_http_session = None
+
+# Keep-alive connection pool for plain HTTP providers (Unsplash).
+def http_session():
+    global _http_session
+    with _providers_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=Config.HTTP_POOL_CONNECTIONS, pool_maxsize=Config.HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+# SDK clients are built on first use rather than at import time, so importing
+# the app neither pays for the SDK imports nor needs the API keys to be set.
+# Modules register a factory per client; register_client again to swap one.
+_client_factories = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+def register_client(name, factory):
+    with _clients_lock:
+        _client_factories[name] = factory
+        _clients.pop(name, None)
+
+def client(name):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = _client_factories[name]()
+        return _clients[name]
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from config import Config
+from models import db, Story, SceneGeneration, GenerationEvent
+from utils.scene_pipeline import generate_scene_events
+from utils.async_pipeline import generate_scene_events_async, run_in_app
+from utils.prefetch import schedule_prefetch, touch
+from utils.metrics import collect_timings
+from utils.media_gc import check_media_quota
+from utils.generation_scheduler import scheduler, QueueFull
+
+logging.basicConfig(level=logging.INFO)
+
+# Scene generations run here, detached from the request that started them, so
+# a dropped connection neither stops the work nor loses its results.
+generation_pool = ThreadPoolExecutor(max_workers=Config.SCENE_GENERATION_WORKERS, thread_name_prefix='scene')
+
+TERMINAL_EVENTS = ('complete', 'error')
+
+# Followers in this process are woken as soon as new events are committed;
+# followers in other processes pick them up on their next poll. Coroutines
+# register a listener instead of blocking on the condition.
+_versions = {}
+_listeners = {}
+_changed = threading.Condition()
+
+def _notify(generation_id):
+    with _changed:
+        _versions[generation_id] = _versions.get(generation_id, 0) + 1
+        _changed.notify_all()
+        listeners = list(_listeners.get(generation_id, ()))
+    for listener in listeners:
+        listener()
+
+def _wait_for_change(generation_id, version, timeout):
+    with _changed:
+        _changed.wait_for(lambda: _versions.get(generation_id, 0) != version, timeout)
+
+class EventLog:
+    def __init__(self, generation_id, seq=0):
+        self.generation_id = generation_id
+        self.seq = seq
+        self.pending = []
+        self.flushed_at = time.monotonic()
+
+    def append(self, event):
+        if self.add(event):
+            self.flush()
+
+    # Text deltas are batched for EVENT_FLUSH_INTERVAL to keep the number of
+    # commits per scene small; every other event is written immediately.
+    # Returns whether the log should be flushed now.
+    def add(self, event):
+        self.seq += 1
+        self.pending.append(GenerationEvent(generation_id=self.generation_id, seq=self.seq, data=json.dumps(event)))
+        return event['status'] != 'text_delta' or time.monotonic() - self.flushed_at >= Config.EVENT_FLUSH_INTERVAL
+
+    def flush(self, **values):
+        db.session.add_all(self.pending)
+        db.session.execute(
+            update(SceneGeneration)
+            .where(SceneGeneration.id == self.generation_id)
+            .values(last_seq=self.seq, updated_at=datetime.utcnow(), **values)
+        )
+        db.session.commit()
+        self.pending = []
+        self.flushed_at = time.monotonic()
+        _notify(self.generation_id)
+
+    def finish(self, event):
+        self.add(event)
+        failed = event['status'] == 'error'
+        self.flush(status='failed' if failed else 'completed', error=event.get('error'))
+        return not failed
+
+# Returns the running generation for the scene if there is one, so a client
+# that reconnects or retries attaches to it instead of paying for the scene
+# twice. Stale generations are abandoned and a new one is started.
+# `runner(app, generation_id, options)` starts the work once the scheduler
+# admits it; by default it goes to the thread pool, the ASGI server schedules
+# a coroutine on its event loop. Raises QueueFull when the generation cannot
+# even be queued.
+def start_generation(app, story_id, act, chapter, scene_number, user_id=None, runner=None, **options):
+    active = SceneGeneration.query.filter_by(story_id=story_id, act=act, chapter=chapter, scene_number=scene_number, status='running').order_by(SceneGeneration.id.desc()).first()
+    if active and not _stale(active.id, active.updated_at):
+        return active, False
+    if active:
+        _abandon(active.id, active.last_seq)
+    generation = SceneGeneration(story_id=story_id, act=act, chapter=chapter, scene_number=scene_number, status='running')
+    db.session.add(generation)
+    db.session.commit()
+    generation_id = generation.id
+    _prune()
+    try:
+        scheduler.submit(app, user_id, generation_id, lambda: (runner or _submit)(app, generation_id, options))
+    except QueueFull:
+        SceneGeneration.query.filter_by(id=generation_id).update({'status': 'failed', 'error': 'Generation queue full'})
+        db.session.commit()
+        raise
+    logging.info(f"Submitted generation {generation_id} for story {story_id}, Act {act}, Chapter {chapter}, Scene {scene_number}")
+    return generation, True
+
+# Starts (or attaches to) the generation a /generate_scene body asks for and
+# returns its id, or None when the story does not belong to the user. Raises
+# QuotaExceeded when the user is out of media storage and QueueFull when the
+# user's generation queue is full.
+def start_scene_request(app, user_id, data, runner=None):
+    story = Story.query.filter_by(id=data['story_id'], user_id=user_id).first()
+    if not story:
+        return None
+    check_media_quota(user_id)
+    touch(story.id)
+    generation, _ = start_generation(
+        app, story.id, data['act'], data['chapter'], data['scene_number'], user_id=user_id, runner=runner,
+        use_cache=data.get('use_cache', True),
+        stream_text=data.get('stream_text'),
+        batch_mode=data.get('batch_mode'),
+        prefetch=data.get('prefetch', Config.PREFETCH_ENABLED),
+        prefetch_depth=data.get('prefetch_depth'),
+        timings=data.get('timings', False)
+    )
+    return generation.id
+
+def _submit(app, generation_id, options):
+    generation_pool.submit(_run, app, generation_id, options)
+
+def _run(app, generation_id, options):
+    with app.app_context():
+        log = EventLog(generation_id)
+        try:
+            generation = db.session.get(SceneGeneration, generation_id)
+            # Continue after the queue position events
+            log.seq = generation.last_seq
+            story = db.session.get(Story, generation.story_id)
+            terminal = None
+            with collect_timings() as stages:
+                for event in generate_scene_events(
+                    story, generation.act, generation.chapter, generation.scene_number,
+                    use_cache=options.get('use_cache', True),
+                    stream_text=options.get('stream_text'),
+                    batch_mode=options.get('batch_mode')
+                ):
+                    if event['status'] in TERMINAL_EVENTS:
+                        terminal = event
+                        continue
+                    log.append(event)
+            if options.get('timings'):
+                log.append(_timings(stages, generation.story_id, generation.act, generation.chapter, generation.scene_number))
+            completed = log.finish(terminal or {"status": "error", "error": "Generation ended without a result"})
+            if completed and options.get('prefetch'):
+                schedule_prefetch(app, story.id, options.get('prefetch_depth'))
+        except Exception as e:
+            logging.error(f"Generation {generation_id} failed: {str(e)}")
+            db.session.rollback()
+            log.pending = []
+            log.finish({"status": "error", "error": str(e)})
+        finally:
+            db.session.remove()
+            scheduler.release(generation_id)
+            with _changed:
+                _versions.pop(generation_id, None)
+
+async def run_generation_async(app, generation_id, options):
+    log = EventLog(generation_id)
+    try:
+        log.seq, generation = await run_in_app(app, _scene_of, generation_id)
+        terminal = None
+        with collect_timings() as stages:
+            async for event in generate_scene_events_async(
+                app, *generation,
+                use_cache=options.get('use_cache', True),
+                stream_text=options.get('stream_text'),
+                batch_mode=options.get('batch_mode')
+            ):
+                if event['status'] in TERMINAL_EVENTS:
+                    terminal = event
+                elif log.add(event):
+                    await run_in_app(app, log.flush)
+        if options.get('timings'):
+            log.add(_timings(stages, *generation))
+        completed = await run_in_app(app, log.finish, terminal or {"status": "error", "error": "Generation ended without a result"})
+        if completed and options.get('prefetch'):
+            await run_in_app(app, schedule_prefetch, app, generation[0], options.get('prefetch_depth'))
+    except Exception as e:
+        logging.error(f"Generation {generation_id} failed: {str(e)}")
+        log.pending = []
+        await run_in_app(app, log.finish, {"status": "error", "error": str(e)})
+    finally:
+        scheduler.release(generation_id)
+        with _changed:
+            _versions.pop(generation_id, None)
+
+# The optional trailer with the time spent in each stage, labelled with the
+# same ids the pipeline traces its spans with.
+def _timings(stages, story_id, act, chapter, scene_number):
+    return {"status": "timings", "story_id": story_id, "scene": f"{act}.{chapter}.{scene_number}", "stages": stages}
+
+def _scene_of(generation_id):
+    generation = db.session.get(SceneGeneration, generation_id)
+    return generation.last_seq, (generation.story_id, generation.act, generation.chapter, generation.scene_number)
+
+# Generations whose log stopped moving died with their process, unless they
+# are still waiting in this process's queue.
+def _stale(generation_id, updated_at):
+    return updated_at < datetime.utcnow() - timedelta(seconds=Config.JOB_STALE_AFTER) and not scheduler.is_queued(generation_id)
+
+# Marks a stale generation failed and closes its log with an error event, so
+# its followers stop waiting. Only applies if the log is still at `seq`; a
+# generation that wrote in the meantime is alive after all.
+def _abandon(generation_id, seq):
+    event = {"status": "error", "error": "Generation abandoned"}
+    abandoned = db.session.execute(
+        update(SceneGeneration)
+        .where(SceneGeneration.id == generation_id, SceneGeneration.status == 'running', SceneGeneration.last_seq == seq)
+        .values(status='failed', error=event['error'], last_seq=seq + 1, updated_at=datetime.utcnow())
+    ).rowcount
+    if abandoned:
+        db.session.add(GenerationEvent(generation_id=generation_id, seq=seq + 1, data=json.dumps(event)))
+        logging.warning(f"Generation {generation_id} abandoned")
+    db.session.commit()
+    if abandoned:
+        _notify(generation_id)
+
+def _read_events(generation_id, after_seq):
+    events = db.session.query(GenerationEvent.seq, GenerationEvent.data).filter(GenerationEvent.generation_id == generation_id, GenerationEvent.seq > after_seq).order_by(GenerationEvent.seq).all()
+    status, last_seq, updated_at = db.session.query(SceneGeneration.status, SceneGeneration.last_seq, SceneGeneration.updated_at).filter_by(id=generation_id).one()
+    read_all = (events[-1].seq if events else after_seq) >= last_seq
+    # The abandon event is picked up by the next read
+    if status == 'running' and read_all and _stale(generation_id, updated_at):
+        _abandon(generation_id, last_seq)
+    return events, status != 'running' and read_all
+
+# Yields (seq, json) for every event after `after_seq`, waiting for new ones
+# until the generation has finished and its whole log has been sent.
+def follow_events(generation_id, after_seq=0):
+    last = after_seq
+    while True:
+        with _changed:
+            version = _versions.get(generation_id, 0)
+        events, finished = _read_events(generation_id, last)
+        for seq, data in events:
+            last = seq
+            yield seq, data
+        if finished:
+            return
+        # End the read transaction so the next poll sees the writer's commits
+        db.session.commit()
+        if not events:
+            _wait_for_change(generation_id, version, Config.EVENT_STREAM_POLL)
+
+async def follow_events_async(app, generation_id, after_seq=0):
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(changed.set)
+
+    with _changed:
+        _listeners.setdefault(generation_id, set()).add(listener)
+    try:
+        last = after_seq
+        while True:
+            changed.clear()
+            events, finished = await run_in_app(app, _read_events, generation_id, last)
+            for seq, data in events:
+                last = seq
+                yield seq, data
+            if finished:
+                return
+            if not events:
+                try:
+                    await asyncio.wait_for(changed.wait(), Config.EVENT_STREAM_POLL)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        with _changed:
+            listeners = _listeners.get(generation_id)
+            listeners.discard(listener)
+            if not listeners:
+                del _listeners[generation_id]
+
+def _prune():
+    cutoff = datetime.utcnow() - timedelta(seconds=Config.EVENT_LOG_RETENTION)
+    expired = db.session.query(SceneGeneration.id).filter(SceneGeneration.status != 'running', SceneGeneration.updated_at < cutoff)
+    GenerationEvent.query.filter(GenerationEvent.generation_id.in_(expired.scalar_subquery())).delete(synchronize_session=False)
+    SceneGeneration.query.filter(SceneGeneration.id.in_(expired.scalar_subquery())).delete(synchronize_session=False)
+    db.session.commit()
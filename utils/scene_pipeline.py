@@ -0,0 +1,173 @@
+import json
+import logging
+import time
+from sqlalchemy import tuple_
+from config import Config
+from models import db, Story, Scene, Paragraph
+from utils.story_generator import generate_scene, stream_scene_paragraphs, generate_chapter_scene_batch
+from utils.outline_index import parse_outline, load_index, build_scene_context, summarize_paragraphs
+from utils.media_executor import MediaBatch
+from utils.prefetch import take_prefetched
+from utils.metrics import span, trace, record, scenes_generated
+
+logging.basicConfig(level=logging.INFO)
+
+# Runs the full text + media pipeline for one scene and checkpoints the result
+# on its Scene row. Yields the same status events the /generate_scene stream
+# sends to the browser, so web requests and background workers share it.
+def generate_scene_events(story, act, chapter, scene_number, use_cache=True, stream_text=None, batch_mode=None):
+    with trace(story_id=story.id, scene=f"{act}.{chapter}.{scene_number}"):
+        yield from _scene_events(story, act, chapter, scene_number, use_cache, stream_text, batch_mode)
+
+def _scene_events(story, act, chapter, scene_number, use_cache, stream_text, batch_mode):
+    started = time.perf_counter()
+    if stream_text is None:
+        stream_text = Config.STREAM_SCENE_TEXT
+    batch_mode = batch_mode or Config.SCENE_BATCH_MODE
+    yield {"status": "generating_paragraphs"}
+    logging.info(f"Starting scene generation for story {story.id}, Act {act}, Chapter {chapter}, Scene {scene_number}")
+
+    batch = MediaBatch(story.id)
+    paragraphs_with_images = {}
+    precomputed = precomputed_text(story, act, chapter, scene_number, use_cache, batch_mode)
+    if precomputed:
+        paragraphs = precomputed['paragraphs']
+        if stream_text:
+            yield {"status": "text_delta", "text": '\n\n'.join(paragraphs)}
+        for i, content in enumerate(paragraphs):
+            if stream_text:
+                yield {"status": "paragraph_complete", "index": i, "content": content}
+            if i in precomputed['media']:
+                paragraphs_with_images[i] = precomputed['media'][i]
+                yield {"status": "image_generated", "paragraph": paragraphs_with_images[i], "index": i}
+            else:
+                batch.submit(i, content)
+    elif stream_text:
+        context = scene_context(story, act, chapter, scene_number)
+        # Media for a paragraph starts as soon as the model closes it, while
+        # the rest of the scene is still streaming in.
+        count = 0
+        for kind, value in stream_scene_paragraphs(story.book_spec, context, act, chapter, scene_number, use_cache=use_cache):
+            if kind == 'text_delta':
+                yield {"status": "text_delta", "text": value}
+            else:
+                batch.submit(count, value)
+                yield {"status": "paragraph_complete", "index": count, "content": value}
+                count += 1
+            for i, para in batch.ready():
+                paragraphs_with_images[i] = para
+                yield {"status": "image_generated", "paragraph": para, "index": i}
+    else:
+        context = scene_context(story, act, chapter, scene_number)
+        with span('scene_text'):
+            paragraphs = generate_scene(story.book_spec, context, act, chapter, scene_number, use_cache=use_cache)
+        for i, content in enumerate(paragraphs):
+            batch.submit(i, content)
+    record('scene_text_ready', time.perf_counter() - started)
+    yield {"status": "paragraphs_generated"}
+
+    logging.info("Generating images and audio for paragraphs")
+    for i, para in batch.as_completed():
+        paragraphs_with_images[i] = para
+        yield {"status": "image_generated", "paragraph": para, "index": i}
+
+    scene_id = checkpoint_scene(story.id, act, chapter, scene_number, paragraphs_with_images)
+    if scene_id is None:
+        yield {"status": "error", "error": "Scene not found"}
+        return
+    record('scene_total', time.perf_counter() - started)
+    scenes_generated.inc(source='precomputed' if precomputed else 'streamed' if stream_text else 'generated')
+
+    yield {"status": "complete", "scene_id": scene_id}
+
+# Text may already exist: speculatively prefetched, or drafted together with
+# the rest of its chapter in one batched call. Returns None when the scene
+# still has to be written.
+def precomputed_text(story, act, chapter, scene_number, use_cache, batch_mode):
+    precomputed = take_prefetched(story.id, act, chapter, scene_number) if use_cache else None
+    if precomputed is None:
+        target = Scene.query.filter_by(story_id=story.id, act=act, chapter=chapter, scene_number=scene_number).first()
+        draft = scene_draft(target)
+        if draft is None and batch_mode == 'chapter' and target and not target.is_generated:
+            draft = generate_chapter_drafts(story, act, chapter, use_cache=use_cache).get(scene_number)
+        if draft:
+            precomputed = {'paragraphs': draft, 'media': {}}
+    return precomputed
+
+# Saves the finished paragraphs, keyed by position, and marks the scene as
+# generated. Returns the scene id, or None if the scene no longer exists.
+def checkpoint_scene(story_id, act, chapter, scene_number, paragraphs_with_images):
+    scene = Scene.query.filter_by(story_id=story_id, act=act, chapter=chapter, scene_number=scene_number).first()
+    if not scene:
+        return None
+    ordered = [paragraphs_with_images[i] for i in sorted(paragraphs_with_images)]
+    summary = summarize_paragraphs([p['content'] for p in ordered])
+    # Everything is prepared before the first write so the write lock is only
+    # held for the delete, insert and update themselves
+    with span('scene_checkpoint'):
+        replace_paragraphs(scene, ordered)
+        scene.summary = summary
+        scene.is_generated = True
+        db.session.commit()
+    return scene.id
+
+def next_ungenerated_scene(story_id):
+    return Scene.query.filter_by(story_id=story_id, is_generated=False).order_by(Scene.act, Scene.chapter, Scene.scene_number).first()
+
+# Prompt context for a scene: the target chapter and its neighbours from the
+# story's outline index plus summaries of the scenes generated before it.
+# Stories created before the index existed get it built on first use; outlines
+# the parser cannot make sense of fall back to the full text.
+def scene_context(story, act, chapter, scene_number):
+    with span('scene_context'):
+        return _scene_context(story, act, chapter, scene_number)
+
+def _scene_context(story, act, chapter, scene_number):
+    index = load_index(story.outline_index)
+    if index is None and story.outline:
+        index = parse_outline(story.outline)
+        Story.query.filter_by(id=story.id).update({'outline_index': json.dumps(index)})
+        db.session.commit()
+    previous = Scene.query.filter(
+        Scene.story_id == story.id,
+        Scene.is_generated == True,
+        Scene.summary.isnot(None),
+        tuple_(Scene.act, Scene.chapter, Scene.scene_number) < (act, chapter, scene_number)
+    ).order_by(Scene.act.desc(), Scene.chapter.desc(), Scene.scene_number.desc()).limit(Config.SCENE_CONTEXT_SUMMARIES).all()
+    summaries = [f"Act {s.act}, Chapter {s.chapter}, Scene {s.scene_number}: {s.summary}" for s in reversed(previous)]
+    return build_scene_context(index, act, chapter, summaries, Config.CHARACTER_PROFILE_CHARS) or story.outline
+
+# Drafts are scenes whose text has been written but whose media has not:
+# the paragraphs exist and is_generated is still False.
+def scene_draft(scene):
+    if not scene or scene.is_generated:
+        return None
+    texts = [text for (text,) in db.session.query(Paragraph.text).filter_by(scene_id=scene.id).order_by(Paragraph.position)]
+    return texts or None
+
+def replace_paragraphs(scene, paragraphs):
+    Paragraph.query.filter_by(scene_id=scene.id).delete()
+    db.session.add_all(Paragraph(
+        scene_id=scene.id,
+        position=position,
+        text=paragraph['content'],
+        image_url=paragraph.get('image_url'),
+        audio_url=paragraph.get('audio_url')
+    ) for position, paragraph in enumerate(paragraphs))
+
+# Writes every scene of a chapter from a single structured LLM call and saves
+# the ungenerated ones as drafts in one transaction.
+def generate_chapter_drafts(story, act, chapter, use_cache=True):
+    scenes = Scene.query.filter_by(story_id=story.id, act=act, chapter=chapter).order_by(Scene.scene_number).all()
+    context = scene_context(story, act, chapter, 1)
+    with span('chapter_batch'):
+        batch = generate_chapter_scene_batch(story.book_spec, context, act, chapter, len(scenes), use_cache=use_cache)
+    drafts = {}
+    for scene, paragraphs in zip(scenes, batch):
+        if scene.is_generated:
+            continue
+        replace_paragraphs(scene, [{'content': p} for p in paragraphs])
+        drafts[scene.scene_number] = paragraphs
+    db.session.commit()
+    logging.info(f"Saved {len(drafts)} scene drafts for story {story.id}, Act {act}, Chapter {chapter}")
+    return drafts
@@ -0,0 +1,77 @@
+import json
+import logging
+from sqlalchemy import inspect, text
+
+logging.basicConfig(level=logging.INFO)
+
+# db.create_all() only creates missing tables; this adds the nullable columns
+# and indexes introduced on existing tables since the database was created.
+def upgrade_schema(db):
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                logging.info(f"Added column {table.name}.{column.name}")
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+                    logging.info(f"Created index {index.name}")
+
+# Moves the JSON paragraph lists stored in Scene.content into Paragraph rows.
+# Each scene is converted and emptied in the same transaction, so the
+# migration can be interrupted and rerun safely.
+def migrate_scene_paragraphs(db, batch_size=200):
+    from models import Scene, Paragraph
+    migrated = 0
+    while True:
+        scenes = Scene.query.filter(Scene.content != '').order_by(Scene.id).limit(batch_size).all()
+        if not scenes:
+            break
+        for scene in scenes:
+            try:
+                items = json.loads(scene.content)
+            except ValueError:
+                items = scene.content
+            # Anything but a list of paragraph objects is kept as text: a
+            # bare string or number is one paragraph, strings in a list are
+            # paragraphs, and nulls are dropped.
+            if not isinstance(items, list):
+                items = [items]
+            items = [item if isinstance(item, dict) else {'content': item if isinstance(item, str) else json.dumps(item)}
+                     for item in items if item is not None]
+            if scene.paragraphs:
+                logging.warning(f"Scene {scene.id} already has paragraphs, dropping its legacy content")
+                items = []
+            for position, item in enumerate(items):
+                db.session.add(Paragraph(
+                    scene_id=scene.id,
+                    position=position,
+                    text=item.get('content') or '',
+                    image_url=item.get('image_url'),
+                    audio_url=item.get('audio_url')
+                ))
+            scene.content = ''
+        db.session.commit()
+        migrated += len(scenes)
+    if migrated:
+        logging.info(f"Migrated paragraphs of {migrated} scenes")
+    return migrated
+
+# The explicit schema step (recreate_db.py): creates missing tables, upgrades
+# existing ones, migrates legacy data and sets up the search index. Web
+# workers and job workers do not run it on boot, so they start without
+# touching the schema.
+def init_db(db):
+    db.create_all()
+    upgrade_schema(db)
+    migrate_scene_paragraphs(db)
+    from utils.search import create_search_index
+    create_search_index(db)
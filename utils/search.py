@@ -0,0 +1,207 @@
+import logging
+import re
+from markupsafe import escape
+from sqlalchemy import inspect, text, bindparam, or_
+from config import Config
+from models import db, Story, Scene, Paragraph
+from utils.metrics import span
+from utils.pagination import encode_cursor, decode_cursor
+
+logging.basicConfig(level=logging.INFO)
+
+# Full-text index over story topics, specs and outlines and over scene
+# paragraphs: FTS5 tables that read their text from the story and paragraph
+# tables (external content) and are kept in sync by triggers, so every write
+# path (scene generation, edits, book jobs, migrations) updates the index in
+# the transaction that changes the text.
+SEARCH_TABLES = ('story_search', 'paragraph_search')
+
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS story_search USING fts5(topic, book_spec, outline, content='story', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS paragraph_search USING fts5(text, content='paragraph', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')",
+    '''CREATE TRIGGER IF NOT EXISTS story_search_insert AFTER INSERT ON story BEGIN
+        INSERT INTO story_search(rowid, topic, book_spec, outline) VALUES (new.id, new.topic, new.book_spec, new.outline);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS story_search_delete AFTER DELETE ON story BEGIN
+        INSERT INTO story_search(story_search, rowid, topic, book_spec, outline) VALUES ('delete', old.id, old.topic, old.book_spec, old.outline);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS story_search_update AFTER UPDATE OF topic, book_spec, outline ON story BEGIN
+        INSERT INTO story_search(story_search, rowid, topic, book_spec, outline) VALUES ('delete', old.id, old.topic, old.book_spec, old.outline);
+        INSERT INTO story_search(rowid, topic, book_spec, outline) VALUES (new.id, new.topic, new.book_spec, new.outline);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS paragraph_search_insert AFTER INSERT ON paragraph BEGIN
+        INSERT INTO paragraph_search(rowid, text) VALUES (new.id, new.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS paragraph_search_delete AFTER DELETE ON paragraph BEGIN
+        INSERT INTO paragraph_search(paragraph_search, rowid, text) VALUES ('delete', old.id, old.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS paragraph_search_update AFTER UPDATE OF text ON paragraph BEGIN
+        INSERT INTO paragraph_search(paragraph_search, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO paragraph_search(rowid, text) VALUES (new.id, new.text);
+    END''',
+]
+
+# Matches are wrapped in these by snippet() and turned into <mark> tags once
+# the rest of the text has been escaped.
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+TERM = re.compile(r'\w+')
+
+# Topic matches count more than spec or outline matches
+STORY_WEIGHTS = '10.0, 2.0, 1.0'
+
+# Ranks the matches without building snippets: snippet() is by far the most
+# expensive part of a query and is only worth running for the page returned.
+RANK_QUERY = f'''
+SELECT kind, row_id FROM (
+    SELECT 'story' AS kind, story.id AS row_id, bm25(story_search, {STORY_WEIGHTS}) AS score
+    FROM story_search JOIN story ON story.id = story_search.rowid
+    WHERE story_search MATCH :query AND story.user_id = :user_id
+    UNION ALL
+    SELECT 'scene', paragraph.id, bm25(paragraph_search)
+    FROM paragraph_search
+    JOIN paragraph ON paragraph.id = paragraph_search.rowid
+    JOIN scene ON scene.id = paragraph.scene_id
+    JOIN story ON story.id = scene.story_id
+    WHERE paragraph_search MATCH :query AND story.user_id = :user_id AND scene.is_generated = 1
+)
+ORDER BY score, kind, row_id
+LIMIT :limit OFFSET :offset
+'''
+
+STORY_SNIPPETS = text('''
+SELECT story.id AS row_id, story.id AS story_id, story.topic AS topic,
+       snippet(story_search, -1, :start, :end, '…', :tokens) AS snippet
+FROM story_search JOIN story ON story.id = story_search.rowid
+WHERE story_search MATCH :query AND story_search.rowid IN :ids
+''').bindparams(bindparam('ids', expanding=True))
+
+PARAGRAPH_SNIPPETS = text('''
+SELECT paragraph.id AS row_id, story.id AS story_id, story.topic AS topic, scene.id AS scene_id, scene.act AS act,
+       scene.chapter AS chapter, scene.scene_number AS scene_number, paragraph.position AS position,
+       snippet(paragraph_search, 0, :start, :end, '…', :tokens) AS snippet
+FROM paragraph_search
+JOIN paragraph ON paragraph.id = paragraph_search.rowid
+JOIN scene ON scene.id = paragraph.scene_id
+JOIN story ON story.id = scene.story_id
+WHERE paragraph_search MATCH :query AND paragraph_search.rowid IN :ids
+''').bindparams(bindparam('ids', expanding=True))
+
+def full_text_available():
+    return db.engine.dialect.name == 'sqlite'
+
+# Creates the index tables and triggers (init_db). An index created over
+# existing rows is filled from them once; afterwards the triggers keep it
+# current.
+def create_search_index(db):
+    if not full_text_available():
+        logging.info("Full-text search needs SQLite FTS5; searches will scan the tables instead")
+        return
+    existing = set(inspect(db.engine).get_table_names())
+    with db.engine.begin() as connection:
+        for statement in SEARCH_SCHEMA:
+            connection.execute(text(statement))
+        for table in SEARCH_TABLES:
+            if table not in existing:
+                connection.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+                logging.info(f"Built search index {table}")
+
+# Rebuilds both indexes from the content tables, e.g. after rows were
+# changed with the triggers missing.
+def rebuild_search_index(db):
+    with db.engine.begin() as connection:
+        for table in SEARCH_TABLES:
+            connection.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+
+# Every word of the query has to appear; the last one also matches as a
+# prefix, so results show up while the user is still typing it (from three
+# letters on; shorter prefixes expand to most of the vocabulary). Words are
+# quoted so FTS5 operators in user input are taken literally.
+def match_expression(query):
+    terms = TERM.findall(query)
+    if not terms:
+        return None
+    quoted = ['"' + term.replace('"', '""') + '"' for term in terms]
+    if len(terms[-1]) >= 3:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def highlight(snippet):
+    return str(escape(snippet or '')).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+# One page of the user's stories and generated scene paragraphs matching
+# `query`, best first, with an HTML snippet around the matches. Ranked
+# results have no stable sort key to resume from, so the cursor is the
+# offset of the next page.
+def search(user_id, query, cursor, limit):
+    offset = decode_cursor(cursor, 1)[0] if cursor else 0
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    expression = match_expression(query)
+    if expression is None:
+        return [], None
+    with span('search'):
+        if full_text_available():
+            results = _ranked(user_id, expression, limit + 1, offset)
+        else:
+            results = _scan(user_id, TERM.findall(query), limit + 1, offset)
+    next_cursor = encode_cursor([offset + limit]) if len(results) > limit else None
+    return results[:limit], next_cursor
+
+def _ranked(user_id, expression, limit, offset):
+    ranked = db.session.execute(text(RANK_QUERY), {'query': expression, 'user_id': user_id, 'limit': limit, 'offset': offset}).all()
+    parameters = {'query': expression, 'start': MATCH_START, 'end': MATCH_END, 'tokens': Config.SEARCH_SNIPPET_TOKENS}
+    found = {}
+    for kind, statement in (('story', STORY_SNIPPETS), ('scene', PARAGRAPH_SNIPPETS)):
+        ids = [row_id for row_kind, row_id in ranked if row_kind == kind]
+        if ids:
+            for row in db.session.execute(statement, dict(parameters, ids=ids)).mappings():
+                found[kind, row['row_id']] = row
+    # Rows deleted between the two queries are left out of the page
+    results = []
+    for kind, row_id in ranked:
+        row = found.get((kind, row_id))
+        if row is None:
+            continue
+        results.append(_result(kind, row['story_id'], row['topic'], row, highlight(row['snippet'])))
+    return results
+
+# Fallback for databases without FTS5: unranked substring matches, stories
+# first. Fine for small libraries only.
+def _scan(user_id, terms, limit, offset):
+    results = []
+    story_filter = [or_(Story.topic.ilike(f'%{term}%'), Story.book_spec.ilike(f'%{term}%'), Story.outline.ilike(f'%{term}%')) for term in terms]
+    stories = Story.query.filter(Story.user_id == user_id, *story_filter).order_by(Story.id).limit(offset + limit).all()
+    for story in stories:
+        source = next(value for value in (story.topic, story.book_spec, story.outline) if value and terms[0].lower() in value.lower())
+        results.append(_result('story', story.id, story.topic, None, _excerpt(source, terms)))
+    paragraphs = (db.session.query(Paragraph, Scene, Story)
+                  .join(Scene, Paragraph.scene_id == Scene.id).join(Story, Scene.story_id == Story.id)
+                  .filter(Story.user_id == user_id, Scene.is_generated == True, *[Paragraph.text.ilike(f'%{term}%') for term in terms])
+                  .order_by(Paragraph.id).limit(offset + limit - len(results)).all()) if len(results) < offset + limit else []
+    for paragraph, scene, story in paragraphs:
+        location = {'scene_id': scene.id, 'act': scene.act, 'chapter': scene.chapter, 'scene_number': scene.scene_number, 'position': paragraph.position}
+        results.append(_result('scene', story.id, story.topic, location, _excerpt(paragraph.text, terms)))
+    return results[offset:offset + limit]
+
+def _result(kind, story_id, topic, scene, snippet):
+    scene = scene if kind == 'scene' else {}
+    return {
+        'kind': kind,
+        'story_id': story_id,
+        'topic': topic,
+        'scene_id': scene.get('scene_id'),
+        'act': scene.get('act'),
+        'chapter': scene.get('chapter'),
+        'scene_number': scene.get('scene_number'),
+        'position': scene.get('position'),
+        'snippet': snippet
+    }
+
+def _excerpt(value, terms):
+    found = value.lower().find(terms[0].lower())
+    start = max(0, found - 60)
+    excerpt = ('…' if start else '') + value[start:found + 100] + ('…' if found + 100 < len(value) else '')
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    return highlight(pattern.sub(lambda match: MATCH_START + match.group(0) + MATCH_END, excerpt))
@@ -0,0 +1,23 @@
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import Config
+
+# Applied to every new SQLite connection. WAL lets page views and event
+# stream followers read while a generation commits, and with synchronous=NORMAL
+# a commit no longer waits for an fsync. Writers still take turns, so the
+# generation code keeps its write transactions short; busy_timeout makes a
+# writer wait for its turn rather than fail.
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={Config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={Config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def tune_sqlite():
+    if not event.contains(Engine, 'connect', _apply_pragmas):
+        event.listen(Engine, 'connect', _apply_pragmas)
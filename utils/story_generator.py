@@ -1,4 +1,5 @@
 from utils.ai_agents import BrainstormingAgent, StoryStructureAgent, SceneCreationAgent
+import json
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -7,29 +8,100 @@ brainstorming_agent = BrainstormingAgent()
 story_structure_agent = StoryStructureAgent()
 scene_creation_agent = SceneCreationAgent()
 
-def generate_book_spec(topic):
+def generate_book_spec(topic, use_cache=True):
     logging.info(f"Generating book specification for topic: {topic}")
-    log_line = brainstorming_agent.generate_log_line(topic)
+    log_line = brainstorming_agent.generate_log_line(topic, use_cache=use_cache)
     book_spec = f"Topic: {topic}\nLog Line: {log_line}"
     logging.info("Book specification generated successfully")
     return book_spec
 
-def generate_outline(book_spec):
+def generate_outline(book_spec, use_cache=True):
     logging.info("Generating story outline")
     log_line = book_spec.split("Log Line: ")[1]
-    outline = story_structure_agent.generate_5_act_structure(log_line)
+    outline = story_structure_agent.generate_5_act_structure(log_line, use_cache=use_cache)
     logging.info("Story outline generated successfully")
     return outline
 
-def generate_scene(book_spec, outline, act, chapter, scene_number):
+def generate_scene(book_spec, outline, act, chapter, scene_number, use_cache=True):
     logging.info(f"Generating scene for Act {act}, Chapter {chapter}, Scene {scene_number}")
-    scene_content = scene_creation_agent.generate_scene(outline, act, chapter, scene_number)
+    scene_content = scene_creation_agent.generate_scene(outline, act, chapter, scene_number, use_cache=use_cache)
     paragraphs = [p.strip() for p in scene_content.split('\n\n') if p.strip()]
     logging.info(f"Generated {len(paragraphs)} paragraphs for the scene")
     return paragraphs
 
-def generate_chapter_scenes(book_spec, outline, act, chapter):
+# Yields ('text_delta', text) for every chunk the model streams back and
+# ('paragraph_complete', paragraph) as soon as a blank line closes a paragraph,
+# splitting exactly like generate_scene does for the buffered response.
+def stream_scene_paragraphs(book_spec, outline, act, chapter, scene_number, use_cache=True):
+    logging.info(f"Streaming scene for Act {act}, Chapter {chapter}, Scene {scene_number}")
+    splitter = ParagraphSplitter()
+    for chunk in scene_creation_agent.stream_scene(outline, act, chapter, scene_number, use_cache=use_cache):
+        yield 'text_delta', chunk
+        for paragraph in splitter.feed(chunk):
+            yield 'paragraph_complete', paragraph
+    for paragraph in splitter.close():
+        yield 'paragraph_complete', paragraph
+    logging.info(f"Streamed {splitter.count} paragraphs for the scene")
+
+async def stream_scene_paragraphs_async(book_spec, outline, act, chapter, scene_number, use_cache=True):
+    logging.info(f"Streaming scene for Act {act}, Chapter {chapter}, Scene {scene_number}")
+    splitter = ParagraphSplitter()
+    async for chunk in scene_creation_agent.stream_scene_async(outline, act, chapter, scene_number, use_cache=use_cache):
+        yield 'text_delta', chunk
+        for paragraph in splitter.feed(chunk):
+            yield 'paragraph_complete', paragraph
+    for paragraph in splitter.close():
+        yield 'paragraph_complete', paragraph
+    logging.info(f"Streamed {splitter.count} paragraphs for the scene")
+
+class ParagraphSplitter:
+    def __init__(self):
+        self.buffer = ''
+        self.count = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        *closed, self.buffer = self.buffer.split('\n\n')
+        return self._paragraphs(closed)
+
+    def close(self):
+        rest, self.buffer = self.buffer, ''
+        return self._paragraphs([rest])
+
+    def _paragraphs(self, texts):
+        paragraphs = [text.strip() for text in texts if text.strip()]
+        self.count += len(paragraphs)
+        return paragraphs
+
+def generate_chapter_scenes(book_spec, outline, act, chapter, use_cache=True):
     logging.info(f"Generating scenes for Act {act}, Chapter {chapter}")
-    scenes = scene_creation_agent.generate_chapter_scenes(outline, act, chapter)
+    scenes = scene_creation_agent.generate_chapter_scenes(outline, act, chapter, use_cache=use_cache)
     logging.info(f"Generated scenes for Chapter {chapter}")
     return scenes
+
+def _parse_chapter_scenes(response, scene_count):
+    data = json.loads(response)
+    scenes = sorted(data['scenes'], key=lambda scene: scene['scene_number'])
+    if [scene['scene_number'] for scene in scenes] != list(range(1, scene_count + 1)):
+        raise ValueError(f"Expected scenes 1-{scene_count}, got {[scene['scene_number'] for scene in scenes]}")
+    result = []
+    for scene in scenes:
+        paragraphs = [p.strip() for p in scene['paragraphs'] if isinstance(p, str) and p.strip()]
+        if not paragraphs:
+            raise ValueError(f"Scene {scene['scene_number']} has no paragraphs")
+        result.append(paragraphs)
+    return result
+
+# One structured LLM call for every scene of a chapter. Returns a list with
+# the paragraphs of each scene, in scene order. Responses are validated
+# before they are cached, so a malformed one is never served again.
+def generate_chapter_scene_batch(book_spec, outline, act, chapter, scene_count, use_cache=True):
+    logging.info(f"Generating {scene_count} scenes in one batch for Act {act}, Chapter {chapter}")
+    parse = lambda response: _parse_chapter_scenes(response, scene_count)
+    try:
+        scenes = scene_creation_agent.generate_chapter_scenes_structured(outline, act, chapter, scene_count, use_cache=use_cache, parse=parse)
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Invalid chapter batch response ({e}), regenerating")
+        scenes = scene_creation_agent.generate_chapter_scenes_structured(outline, act, chapter, scene_count, use_cache=use_cache, parse=parse)
+    logging.info(f"Generated {sum(len(s) for s in scenes)} paragraphs across {len(scenes)} scenes")
+    return scenes
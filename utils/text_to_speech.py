@@ -1,18 +1,181 @@
+import asyncio
+import hashlib
+import logging
 import os
-from gtts import gTTS
-import time
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import unicodedata
+from io import BytesIO
+from config import Config
+from utils.media_store import store_blob
+from utils.metrics import tts_sentences
+from utils.providers import provider, register_client, client
+
+logging.basicConfig(level=logging.INFO)
+
+def _gtts_client():
+    from gtts import gTTS
+    return gTTS
+
+register_client('gtts', _gtts_client)
+
+# A sentence runs up to its closing punctuation and any quotes or brackets
+# right after it; trailing text without punctuation is a sentence too.
+SENTENCE = re.compile(r'\S.*?(?:[.!?…]+["\'”’)\]]*(?=\s|$)|$)', re.S)
+WHITESPACE = re.compile(r'\s+')
+
+# Synthesis backends: `synthesize(text, voice, language, timeout)` returns
+# MP3 bytes. TTS_BACKEND picks one; its calls go through the provider gateway
+# under the backend's name, so each has its own limits in PROVIDER_LIMITS.
+_backends = {}
+
+def register_tts_backend(name, synthesize):
+    _backends[name] = synthesize
+
+# Google's online TTS; the voice is the regional domain that sets the accent.
+def _gtts_synthesize(text, voice, language, timeout):
+    buffer = BytesIO()
+    client('gtts')(text=text, lang=language, tld=voice, timeout=timeout).write_to_fp(buffer)
+    return buffer.getvalue()
+
+# A local engine run as a shell command (TTS_COMMAND) that reads the text on
+# stdin and writes MP3 to stdout, e.g.
+# "espeak-ng -v {voice} --stdout | lame --quiet - -". Works offline.
+def _command_synthesize(text, voice, language, timeout):
+    if not Config.TTS_COMMAND:
+        raise RuntimeError("TTS_COMMAND is not set")
+    command = Config.TTS_COMMAND.format(voice=shlex.quote(voice), language=shlex.quote(language))
+    result = subprocess.run(command, shell=True, input=text.encode(), capture_output=True, timeout=timeout)
+    if result.returncode:
+        raise RuntimeError(f"TTS command failed ({result.returncode}): {result.stderr.decode(errors='replace')[:200]}")
+    return result.stdout
+
+register_tts_backend('gtts', _gtts_synthesize)
+register_tts_backend('command', _command_synthesize)
+
+def split_sentences(text):
+    return [match.group(0).strip() for match in SENTENCE.finditer(text or '')]
+
+def normalize_sentence(sentence):
+    return WHITESPACE.sub(' ', unicodedata.normalize('NFKC', sentence)).strip()
+
+# Cached audio is keyed by everything that changes how a sentence sounds.
+def sentence_digest(sentence):
+    key = '\0'.join((Config.TTS_BACKEND, Config.TTS_VOICE, Config.TTS_LANGUAGE, normalize_sentence(sentence)))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+# Paragraphs of a scene are voiced in parallel and often share sentences;
+# holding a lock per digest while synthesizing makes the second paragraph
+# wait for the first one's result instead of paying for the sentence again.
+_digest_locks = [threading.Lock() for _ in range(64)]
+
+def _digest_lock(digest):
+    return _digest_locks[int(digest[:8], 16) % len(_digest_locks)]
+
+def _cache_path(digest):
+    return os.path.join(Config.TTS_CACHE_PATH, f"{digest}.mp3")
+
+def _read_cached(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Hits refresh the mtime, which is what the media collector ages by
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+def _write_cached(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+# Sentence files are concatenated into paragraph files, so any ID3 tags are
+# dropped and only the MPEG frames kept.
+def _frames(data):
+    start = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        start = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]) + (10 if data[5] & 0x10 else 0)
+    end = len(data) - 128 if len(data) - start >= 128 and data[-128:-125] == b'TAG' else len(data)
+    return data[start:end]
+
+def _backend():
+    synthesize = _backends.get(Config.TTS_BACKEND)
+    if synthesize is None:
+        raise RuntimeError(f"Unknown TTS backend: {Config.TTS_BACKEND}")
+    return synthesize
+
+def synthesize_sentence(sentence):
+    digest = sentence_digest(sentence)
+    path = _cache_path(digest)
+    with _digest_lock(digest):
+        data = _read_cached(path)
+        if data is not None:
+            tts_sentences.inc(outcome='cached')
+            return data
+        synthesize = _backend()
+        data = _frames(provider(Config.TTS_BACKEND).call(
+            lambda timeout: synthesize(sentence, Config.TTS_VOICE, Config.TTS_LANGUAGE, timeout)
+        ))
+        _write_cached(path, data)
+    tts_sentences.inc(outcome='synthesized')
+    return data
+
+# The backends are blocking, so requests run in worker threads while the
+# gateway's rate limit and concurrency slots are awaited on the event loop.
+async def synthesize_sentence_async(sentence):
+    path = _cache_path(sentence_digest(sentence))
+    data = await asyncio.to_thread(_read_cached, path)
+    if data is not None:
+        tts_sentences.inc(outcome='cached')
+        return data
+    synthesize = _backend()
+    data = _frames(await provider(Config.TTS_BACKEND).call_async(
+        lambda timeout: asyncio.to_thread(synthesize, sentence, Config.TTS_VOICE, Config.TTS_LANGUAGE, timeout)
+    ))
+    await asyncio.to_thread(_write_cached, path, data)
+    tts_sentences.inc(outcome='synthesized')
+    return data
+
+# The paragraph's audio one sentence at a time, in reading order. Only
+# sentences missing from the cache reach the backend, so an edited paragraph
+# costs as many calls as sentences were changed.
+def paragraph_audio_chunks(text):
+    for sentence in split_sentences(text):
+        yield synthesize_sentence(sentence)
 
 def generate_audio_for_scene(scene_content):
-    # Ensure the audio directory exists
-    audio_dir = os.path.join('static', 'audio')
-    os.makedirs(audio_dir, exist_ok=True)
-    
-    # Generate audio using gTTS
-    tts = gTTS(text=scene_content, lang='en')
-    
-    # Save the audio file
-    filename = f"scene_audio_{int(time.time())}.mp3"
-    filepath = os.path.join(audio_dir, filename)
-    tts.save(filepath)
-    
-    return f"/static/audio/{filename}"
+    audio = b''.join(paragraph_audio_chunks(scene_content))
+    # Store the audio under its content digest; identical audio is written once
+    return store_blob(audio, 'audio', 'mp3') if audio else None
+
+# Sentences are voiced concurrently, each distinct one once.
+async def generate_audio_for_scene_async(scene_content):
+    sentences = split_sentences(scene_content)
+    unique = list(dict.fromkeys(sentences))
+    voiced = dict(zip(unique, await asyncio.gather(*(synthesize_sentence_async(sentence) for sentence in unique))))
+    audio = b''.join(voiced[sentence] for sentence in sentences)
+    return await asyncio.to_thread(store_blob, audio, 'audio', 'mp3') if audio else None
+
+# Sends each sentence as soon as it is ready, so playback starts after the
+# first one, and stores the assembled paragraph file once all have been
+# sent. `on_stored(url)` is called with its URL.
+def stream_paragraph_audio(text, on_stored):
+    chunks = []
+    for chunk in paragraph_audio_chunks(text):
+        chunks.append(chunk)
+        yield chunk
+    if chunks:
+        on_stored(store_blob(b''.join(chunks), 'audio', 'mp3'))
@@ -0,0 +1,24 @@
+import argparse
+import logging
+import multiprocessing
+
+def work(once):
+    from app import app, db
+    from utils.generation_jobs import run_worker
+    with app.app_context():
+        # Never reuse pooled connections inherited from the parent process
+        db.engine.dispose()
+    run_worker(app, once=once)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate queued stories in the background.")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help="number of worker processes on this node")
+    parser.add_argument('--once', action='store_true', help="exit when no job is waiting instead of polling")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    workers = [multiprocessing.Process(target=work, args=(args.once,), daemon=True) for _ in range(args.processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()